@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#Scale benchmark for SetupCondorDTITK.py
+
+doc = """
+DTITK Condor Setup Benchmark.
+
+Generates synthetic cohorts with tiny fake SPD files, stubs out DTI-TK, and times each phase of the setup.
+Every run is appended to a results file, and compared with the previous run of the same cohort size.
+
+Usage:
+  BenchmarkCondorDTITK.py [options] <benchmark_dir>
+
+Arguments:
+  <benchmark_dir>         A scratch directory for the synthetic cohorts, stub tools and generated scripts.
+
+Options:
+  -h --help               Show this screen.
+  -k --keep               Keep the generated cohorts and scripts [default: False]
+  --sizes=<sizes>         Comma separated cohort sizes to benchmark [default: 10,100,1000,10000]
+  --results=<resultfile>  JSON lines file that the results are appended to [default: benchmark_results.jsonl]
+  --slowdown=<ratio>      Report a regression when a phase takes this many times longer than in the previous run [default: 1.5]
+  --setupargs=<args>      Extra options passed on to the setup, e.g. "--maps=fa,md --maxjobs=rigid=500"
+  """
+
+#============================================================================
+#============ Importing things ==============================================
+
+import os, sys, shutil, gzip, struct, time, json, subprocess, logging
+from docopt import docopt
+import SetupCondorDTITK
+
+#Only the public API of the setup is used: makeArguments, setup, the plan it returns and its logger.
+
+#============================================================================
+#============Synthetic Cohort================================================
+
+def writeFakeSPD(path):
+  #A gzipped NIfTI-1 header for an 8x8x4 volume with 6 tensor components and 1mm voxels, followed by no data.
+  header = struct.pack("<i10s18sihsB", 348, "", "", 0, 0, "r", 0)
+  header = header + struct.pack("<8h", 5, 8, 8, 4, 1, 6, 1, 1)
+  header = header + struct.pack("<3f", 0, 0, 0)
+  header = header + struct.pack("<4h", 1007, 32, 0, 0)
+  header = header + struct.pack("<8f", 1, 1, 1, 1, 1, 1, 1, 1)
+  header = header + struct.pack("<f", 352)
+  header = header.ljust(344, "\0") + "n+1\0" + "\0" * 4
+  spdFile = gzip.open(path, "wb")
+  spdFile.write(header)
+  spdFile.close()
+
+def createCohort(CohortDir, scanCount):
+  #Create the fake scans and the subject file for them.
+  os.mkdir("{0}/data".format(CohortDir))
+  writeFakeSPD("{0}/data/template_spd.nii.gz".format(CohortDir))
+  subjectFile = "{0}/subjects.csv".format(CohortDir)
+  with open(subjectFile, "w") as csvfile:
+    csvfile.write("ID,PATH\n")
+    for scan in range(0, scanCount):
+      scanPath = "{0}/data/sub{1:05d}_spd.nii.gz".format(CohortDir, scan)
+      os.link("{0}/data/template_spd.nii.gz".format(CohortDir), scanPath)
+      csvfile.write("sub{0:05d},{1}\n".format(scan, scanPath))
+  return subjectFile
+
+def createStubTools(BenchDir):
+  #Stand-ins for DTI-TK. Setup reads the scan geometry from the fake headers itself, so the registration tools just succeed.
+  dtitkRoot = "{0}/dtitk".format(BenchDir)
+  for directory in [dtitkRoot, "{0}/scripts".format(dtitkRoot), "{0}/bin".format(dtitkRoot)]:
+    if not os.path.exists(directory):
+      os.mkdir(directory)
+  stubs = {}
+  stubs["{0}/scripts/dtitk_common.sh".format(dtitkRoot)] = "#!/bin/bash\n"
+  for tool in ["dti_rigid_reg", "dti_affine_reg", "dti_diffeomorphic_reg"]:
+    stubs["{0}/scripts/{1}".format(dtitkRoot, tool)] = "#!/bin/bash\nexit 0\n"
+  for tool in ["TVMean", "TVResample", "TVtool", "VVMean", "dfToInverse", "affine3Dtool", "affine3DShapeAverage", "affineSymTensor3DVolume", "deformationSymTensor3DVolume", "BinaryThresholdImageFilter"]:
+    stubs["{0}/bin/{1}".format(dtitkRoot, tool)] = "#!/bin/bash\nexit 0\n"
+  for stub, contents in stubs.items():
+    with open(stub, "w") as stubFile:
+      stubFile.write(contents)
+    os.chmod(stub, 0755)
+  return dtitkRoot
+
+#============================================================================
+#============Timing and Counting=============================================
+
+class OutputCounter(object):
+  #Swallows what setup logs at the default command line level, counting the lines and bytes.
+  def __init__(self):
+    self.lines = 0
+    self.bytes = 0
+  def write(self, text):
+    self.lines = self.lines + text.count("\n")
+    self.bytes = self.bytes + len(text)
+  def flush(self):
+    pass
+
+def phaseResults(phases):
+  #The seconds, files, bytes and links of each phase the setup reported in its plan. A name used by both createPlan and materialize gets a number.
+  results = []
+  seen = {}
+  for phase in phases:
+    seen[phase["NAME"]] = seen.get(phase["NAME"], 0) + 1
+    name = phase["NAME"]
+    if seen[name] > 1:
+      name = "{0} ({1})".format(name, seen[name])
+    results.append({"name":name, "seconds":phase["SECONDS"], "files":phase["FILES"], "bytes":phase["BYTES"], "links":phase["LINKS"]})
+  return results
+
+def countTree(Dir):
+  #Count the files, symlinks and bytes written below a directory.
+  files = 0
+  links = 0
+  bytes = 0
+  for root, dirs, filenames in os.walk(Dir):
+    for filename in filenames:
+      path = os.path.join(root, filename)
+      if os.path.islink(path):
+        links = links + 1
+      else:
+        files = files + 1
+        bytes = bytes + os.path.getsize(path)
+  return files, links, bytes
+
+def gitRevision():
+  try:
+    return subprocess.Popen(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0].strip()
+  except OSError:
+    return ""
+
+#============================================================================
+#============Benchmark=======================================================
+
+def benchmarkSize(BenchDir, dtitkRoot, scanCount, setupArgs):
+  CohortDir = "{0}/cohort_{1}".format(BenchDir, scanCount)
+  if os.path.exists(CohortDir):
+    shutil.rmtree(CohortDir)
+  os.mkdir(CohortDir)
+  subjectFile = createCohort(CohortDir, scanCount)
+  ScriptsDir = "{0}/scripts".format(CohortDir)
+  NormDir = "{0}/norm".format(CohortDir)
+
+  arguments = SetupCondorDTITK.makeArguments(setupArgs + [subjectFile, dtitkRoot, ScriptsDir, NormDir])
+  counter = OutputCounter()
+  handler = logging.StreamHandler(counter)
+  handler.setFormatter(SetupCondorDTITK.CommandLineFormatter())
+  SetupCondorDTITK.log.addHandler(handler)
+  SetupCondorDTITK.log.setLevel(logging.INFO)
+  start = time.time()
+  try:
+    plan = SetupCondorDTITK.setup(arguments)
+  finally:
+    totalTime = time.time() - start
+    SetupCondorDTITK.log.removeHandler(handler)
+
+  scriptFiles, scriptLinks, scriptBytes = countTree(ScriptsDir)
+  normFiles, normLinks, normBytes = countTree(NormDir)
+  return {"scans":scanCount, "seconds":totalTime, "phases":phaseResults(plan["phases"]),
+          "files":scriptFiles + normFiles, "links":scriptLinks + normLinks, "bytes":scriptBytes + normBytes,
+          "printedLines":counter.lines, "printedBytes":counter.bytes}
+
+def previousResults(resultFile):
+  #The most recent earlier result for each cohort size. Results of older benchmarks, which timed functions rather than phases, are skipped.
+  previous = {}
+  if os.path.exists(resultFile):
+    with open(resultFile) as results:
+      for line in results:
+        if line.strip() != "":
+          result = json.loads(line)
+          if isinstance(result["phases"], list):
+            previous[result["scans"]] = result
+  return previous
+
+def reportResult(result, previous, slowdown):
+  #Print one cohort size, and return the phases that got slower than allowed since the previous run.
+  regressions = []
+  print("{0} scans: {1:.2f}s, {2} files, {3} links, {4} bytes written, {5} lines printed".format(result["scans"], result["seconds"], result["files"], result["links"], result["bytes"], result["printedLines"]))
+  previousSeconds = {}
+  if previous != None:
+    for phase in previous["phases"]:
+      previousSeconds[phase["name"]] = phase["seconds"]
+  for phase in result["phases"]:
+    line = "  {0:<40} {1:8.3f}s {2:7d} files {3:10d} bytes {4:7d} links".format(phase["name"], phase["seconds"], phase["files"], phase["bytes"], phase["links"])
+    if previousSeconds.get(phase["name"], 0.0) > 0.01:
+      ratio = phase["seconds"] / previousSeconds[phase["name"]]
+      line = line + "  ({0:.2f}x of {1})".format(ratio, previous["version"])
+      if ratio > slowdown:
+        regressions.append(phase["name"])
+        line = line + "  REGRESSION"
+    print(line)
+  return regressions
+
+def go(args):
+  arguments = docopt(doc, argv=args)
+  BenchDir = os.path.abspath(arguments["<benchmark_dir>"])
+  if not os.path.exists(BenchDir):
+    os.mkdir(BenchDir)
+  dtitkRoot = createStubTools(BenchDir)
+  setupArgs = []
+  if arguments["--setupargs"]:
+    setupArgs = arguments["--setupargs"].split()
+  slowdown = float(arguments["--slowdown"])
+  previous = previousResults(arguments["--results"])
+  version = "{0}-{1}".format(SetupCondorDTITK.Version, gitRevision())
+
+  regressions = []
+  for size in arguments["--sizes"].split(","):
+    scanCount = int(size)
+    result = benchmarkSize(BenchDir, dtitkRoot, scanCount, setupArgs)
+    result["version"] = version
+    result["setupArgs"] = setupArgs
+    result["date"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    regressions.extend(reportResult(result, previous.get(scanCount), slowdown))
+    with open(arguments["--results"], "a") as results:
+      results.write("{0}\n".format(json.dumps(result, sort_keys=True)))
+    if arguments["--keep"] == False:
+      shutil.rmtree("{0}/cohort_{1}".format(BenchDir, scanCount))
+
+  if len(regressions) > 0:
+    print("Regressions found in: {0}".format(", ".join(sorted(set(regressions)))))
+    sys.exit(1)
+
+#============================================================================
+#============ Main ==========================================================
+
+if __name__ == '__main__':
+    args = sys.argv
+    del args[0]
+    go(args)
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+#Live throughput and ETA forecasts for a running DTITK Condor DAG
+#Unlike SetupCondorDTITK.py it runs under both Python 2.7 and Python 3, so it can be started wherever docopt is installed.
+
+from __future__ import division, print_function
+
+doc = """
+DTITK Condor Forecast.
+
+Follows the condor logs of the jobs set up by SetupCondorDTITK.py as they are written, and publishes the throughput,
+the predicted finish time of every stage and the overall ETA with confidence bounds as a JSON file in the monitor directory.
+
+Usage:
+  ForecastCondorDTITK.py [options] <script_output_dir> <monitor_dir>
+
+Arguments:
+  <script_output_dir>     The script output directory given to SetupCondorDTITK.py
+  <monitor_dir>           The directory of the monitoring web page. The forecast is written next to it.
+
+Options:
+  -h --help               Show this screen.
+  --once                  Write a single forecast and exit.
+  --interval=<seconds>    Seconds between forecasts [default: 300]
+  --alpha=<alpha>         Weight of the newest observation in the moving averages [default: 0.3]
+  --output=<name>         Name of the forecast file in the monitor directory [default: forecast.json]
+  """
+
+#============================================================================
+#============ Importing things ==============================================
+
+import os, sys, re, glob, time, json, math
+from docopt import docopt
+
+#============================================================================
+#============Condor Log Reading==============================================
+
+eventPattern = re.compile(r"^(\d{3}) \((\d+)\.(\d+)\.(\d+)\) (\S+) (\S+)")
+returnPattern = re.compile(r"return value (-?\d+)")
+
+def parseEventTime(date, clock, now):
+  #Condor writes either "2016-10-19 02:52:11", or in older versions "10/19 02:52:11" without the year.
+  if "T" in date:
+    date, clock = date.split("T", 1)
+  if "-" in date:
+    return time.mktime(time.strptime("{0} {1}".format(date, clock[:8]), "%Y-%m-%d %H:%M:%S"))
+  year = time.localtime(now).tm_year
+  stamp = time.mktime(time.strptime("{0}/{1} {2}".format(year, date, clock[:8]), "%Y/%m/%d %H:%M:%S"))
+  if stamp > now + 86400:
+    stamp = time.mktime(time.strptime("{0}/{1} {2}".format(year - 1, date, clock[:8]), "%Y/%m/%d %H:%M:%S"))
+  return stamp
+
+def newNode(script):
+  return {"SCRIPT":script, "POSITION":0, "ATTEMPTS":0, "STATUS":"waiting", "SUBMITTED":None, "EXECUTED":None, "TERMINATED":None}
+
+def nodeScript(name, stages):
+  #Group nodes are named after their script, individual ones are "<scan or batch>_<script>".
+  if name in stages:
+    return name
+  position = name.rfind("_Individual_")
+  if position >= 0 and name[position + 1:] in stages:
+    return name[position + 1:]
+  return None
+
+def readNodeLog(path, node, now):
+  #Apply the events appended to a node's log since the last read. Events end with a "..." line; a partly written one is left for next time.
+  #The log is read as bytes, so POSITION is a byte offset under both Python 2 and 3.
+  if os.path.getsize(path) <= node["POSITION"]:
+    return
+  with open(path, "rb") as logFile:
+    logFile.seek(node["POSITION"])
+    data = logFile.read()
+  end = data.rfind(b"...\n")
+  if end < 0:
+    return
+  node["POSITION"] = node["POSITION"] + end + 4
+  text = data[:end].decode("utf-8", "replace")
+  for event in text.split("...\n"):
+    match = eventPattern.match(event.lstrip())
+    if match == None:
+      continue
+    code = match.group(1)
+    stamp = parseEventTime(match.group(5), match.group(6), now)
+    if code == "000":
+      #Submitted, again when DAGMan retries the node
+      node["ATTEMPTS"] = node["ATTEMPTS"] + 1
+      node["SUBMITTED"] = stamp
+      node["EXECUTED"] = None
+      node["TERMINATED"] = None
+      node["STATUS"] = "idle"
+    elif code == "001":
+      node["EXECUTED"] = stamp
+      node["STATUS"] = "running"
+    elif code == "004":
+      #Evicted, back in the queue
+      node["EXECUTED"] = None
+      node["STATUS"] = "idle"
+    elif code == "005":
+      node["TERMINATED"] = stamp
+      returnValue = returnPattern.search(event)
+      if returnValue != None and int(returnValue.group(1)) == 0:
+        node["STATUS"] = "done"
+      else:
+        node["STATUS"] = "failed"
+    elif code == "009":
+      node["TERMINATED"] = stamp
+      node["STATUS"] = "failed"
+    elif code == "012":
+      node["STATUS"] = "held"
+    elif code == "013":
+      node["STATUS"] = "idle"
+
+def readLogs(ScriptsDir, stages, nodes, now):
+  #Update nodes (node name -> state) from the condor logs. Logs appear as DAGMan submits their jobs, and finished jobs are not read again.
+  for path in glob.glob("{0}/condorlogs/*_log.txt".format(ScriptsDir)):
+    name = os.path.basename(path)[:-len("_log.txt")]
+    if name not in nodes:
+      script = nodeScript(name, stages)
+      if script == None:
+        continue
+      nodes[name] = newNode(script)
+    if nodes[name]["STATUS"] != "done":
+      readNodeLog(path, nodes[name], now)
+
+#============================================================================
+#============Moving Averages=================================================
+
+def movingAverage(values, alpha):
+  #Exponentially weighted mean and variance of values, oldest first.
+  mean = None
+  variance = 0.0
+  for value in values:
+    if mean == None:
+      mean = value
+    else:
+      difference = value - mean
+      mean = mean + alpha * difference
+      variance = (1 - alpha) * (variance + alpha * difference * difference)
+  return mean, variance
+
+def completionRate(start, completions, alpha):
+  #Moving completion rate (jobs per second) from the intervals between completions, starting at the first execution.
+  intervals = []
+  previous = start
+  for completion in completions:
+    intervals.append(max(completion - previous, 0.0))
+    previous = completion
+  interval = movingAverage(intervals, alpha)[0]
+  if interval == None:
+    return None
+  return 1.0 / max(interval, 1.0)
+
+#============================================================================
+#============Stage Model=====================================================
+
+def stageWeight(script):
+  #Relative cost of a job. Diffeomorphic iteration n registers n resolution levels.
+  match = re.match(r"Individual_Diffeomorphic(\d+)", script)
+  if match != None:
+    return int(match.group(1))
+  return 1
+
+def summarizeStages(stagesInfo, nodes, alpha):
+  #Count the jobs of every stage by status, and collect their timing.
+  summaries = {}
+  for stage in stagesInfo["stages"]:
+    summaries[stage["NAME"]] = {"NAME":stage["NAME"], "CATEGORY":stage["CATEGORY"], "TYPE":stage["TYPE"], "JOBS":stage["JOBS"], "WEIGHT":stageWeight(stage["NAME"]),
+                                "done":0, "running":0, "idle":0, "held":0, "failed":0, "SUBMITTED":None, "EXECUTED":None, "COMPLETIONS":[], "DURATIONS":[], "WAITS":[]}
+  for node in nodes.values():
+    summary = summaries[node["SCRIPT"]]
+    if node["STATUS"] in summary:
+      summary[node["STATUS"]] = summary[node["STATUS"]] + 1
+    if node["SUBMITTED"] != None and (summary["SUBMITTED"] == None or node["SUBMITTED"] < summary["SUBMITTED"]):
+      summary["SUBMITTED"] = node["SUBMITTED"]
+    if node["EXECUTED"] != None and (summary["EXECUTED"] == None or node["EXECUTED"] < summary["EXECUTED"]):
+      summary["EXECUTED"] = node["EXECUTED"]
+    if node["STATUS"] == "done":
+      summary["COMPLETIONS"].append(node["TERMINATED"])
+      if node["EXECUTED"] != None:
+        summary["DURATIONS"].append((node["TERMINATED"], (node["TERMINATED"] - node["EXECUTED"]) / summary["WEIGHT"]))
+        summary["WAITS"].append((node["TERMINATED"], node["EXECUTED"] - node["SUBMITTED"]))
+  for summary in summaries.values():
+    summary["COMPLETIONS"].sort()
+    summary["DURATIONS"].sort()
+    summary["WAITS"].sort()
+    summary["RATE"] = None
+    if len(summary["COMPLETIONS"]) > 0 and summary["EXECUTED"] != None:
+      summary["RATE"] = completionRate(summary["EXECUTED"], summary["COMPLETIONS"], alpha)
+  return summaries
+
+def createCategoryModels(summaries, alpha):
+  #Per category: moving mean and variance of the job run time per unit of weight, the moving queue wait,
+  #and the moving parallelism (jobs running at once) seen by the stages with at least two finished jobs.
+  #Categories without finished jobs yet borrow the model of all jobs together.
+  observations = {}
+  for summary in summaries.values():
+    for category in [summary["CATEGORY"], "all"]:
+      observation = observations.setdefault(category, {"DURATIONS":[], "WAITS":[], "PARALLELISM":[]})
+      observation["DURATIONS"].extend(summary["DURATIONS"])
+      observation["WAITS"].extend(summary["WAITS"])
+      if summary["TYPE"] == "individual" and len(summary["DURATIONS"]) > 1:
+        lastCompletion = summary["COMPLETIONS"][-1]
+        throughput = len(summary["COMPLETIONS"]) / max(lastCompletion - summary["EXECUTED"], 1.0)
+        meanDuration = sum([duration for stamp, duration in summary["DURATIONS"]]) / len(summary["DURATIONS"]) * summary["WEIGHT"]
+        observation["PARALLELISM"].append((lastCompletion, throughput * meanDuration))
+  models = {}
+  for category, observation in observations.items():
+    if len(observation["DURATIONS"]) == 0:
+      continue
+    mean, variance = movingAverage([duration for stamp, duration in sorted(observation["DURATIONS"])], alpha)
+    wait = movingAverage([wait for stamp, wait in sorted(observation["WAITS"])], alpha)[0]
+    parallelism = movingAverage([parallelism for stamp, parallelism in sorted(observation["PARALLELISM"])], alpha)[0]
+    models[category] = {"MEAN":mean, "SD":math.sqrt(variance), "WAIT":wait, "PARALLELISM":parallelism}
+  if "all" in models:
+    for summary in summaries.values():
+      if summary["CATEGORY"] not in models:
+        models[summary["CATEGORY"]] = models["all"]
+  return models
+
+#============================================================================
+#============Forecast========================================================
+
+#Multiples of the standard deviation for the estimate and its 95% bounds
+bounds = {"est":0.0, "low":-1.96, "high":1.96}
+
+def stageWallTime(summary, model, bound, runningJobs):
+  #Predicted time from submitting a stage to its last job finishing.
+  perJob = max(model["MEAN"] + bounds[bound] * model["SD"], 0.0) * summary["WEIGHT"]
+  if summary["TYPE"] == "group":
+    return model["WAIT"] + perJob
+  parallelism = model["PARALLELISM"]
+  if parallelism == None:
+    #No stage of this category has finished yet; assume the pool keeps running as many jobs as it does now.
+    parallelism = runningJobs
+  parallelism = max(parallelism, 1.0)
+  return model["WAIT"] + max(perJob, summary["JOBS"] * perJob / parallelism)
+
+def predictStage(summary, model, bound, start, now, runningJobs):
+  #Predicted finish time of one stage, given when it can start.
+  if summary["done"] == summary["JOBS"]:
+    return summary["COMPLETIONS"][-1]
+  if summary["SUBMITTED"] == None:
+    return start + stageWallTime(summary, model, bound, runningJobs)
+  completed = len(summary["COMPLETIONS"])
+  if summary["TYPE"] == "individual" and completed > 1 and summary["RATE"] != None:
+    #Enough finished jobs to extrapolate the stage's own moving completion rate
+    remaining = (summary["JOBS"] - summary["done"]) / summary["RATE"]
+    return now + max(remaining * (1 + bounds[bound] / math.sqrt(completed)), 0.0)
+  return max(now, summary["SUBMITTED"] + stageWallTime(summary, model, bound, runningJobs))
+
+def createForecast(stagesInfo, nodes, alpha, now):
+  summaries = summarizeStages(stagesInfo, nodes, alpha)
+  models = createCategoryModels(summaries, alpha)
+  runningJobs = sum([summary["running"] for summary in summaries.values()])
+  jobs = {"total":0, "done":0, "running":0, "idle":0, "held":0, "failed":0}
+  for summary in summaries.values():
+    jobs["total"] = jobs["total"] + summary["JOBS"]
+    for status in ["done", "running", "idle", "held", "failed"]:
+      jobs[status] = jobs[status] + summary[status]
+
+  #Stages start once the stage before them in their chain has finished, so predictions follow the chains.
+  parents = {}
+  order = []
+  for chain in stagesInfo["chains"]:
+    for step in range(0, len(chain)):
+      if chain[step] not in order:
+        order.append(chain[step])
+      if step > 0:
+        parents.setdefault(chain[step], []).append(chain[step - 1])
+  finishes = {}
+  for name in order:
+    summary = summaries[name]
+    model = models.get(summary["CATEGORY"])
+    if summary["done"] < summary["JOBS"] and model == None:
+      continue
+    finishes[name] = {}
+    for bound in bounds.keys():
+      parentFinishes = [finishes[parent][bound] for parent in parents.get(name, []) if parent in finishes]
+      if len(parentFinishes) < len(parents.get(name, [])):
+        del finishes[name]
+        break
+      start = max([now] + parentFinishes)
+      finishes[name][bound] = predictStage(summary, model, bound, start, now, runningJobs)
+
+  #The DAG stops submitting once a job fails for good, so there is no ETA until it is resubmitted.
+  if jobs["done"] == jobs["total"]:
+    status = "finished"
+  elif jobs["failed"] > 0 and jobs["running"] + jobs["idle"] + jobs["held"] == 0:
+    status = "stalled"
+  elif jobs["done"] + jobs["running"] + jobs["idle"] + jobs["held"] + jobs["failed"] == 0:
+    status = "waiting"
+  else:
+    status = "running"
+
+  forecast = {"generated":timeString(now), "version":stagesInfo["version"], "status":status, "scans":stagesInfo["scans"], "jobs":jobs,
+              "jobsPerHour":None, "scansPerHour":None, "currentStage":None, "eta":None, "stages":[]}
+  allCompletions = sorted(sum([summary["COMPLETIONS"] for summary in summaries.values()], []))
+  allExecuted = [summary["EXECUTED"] for summary in summaries.values() if summary["EXECUTED"] != None]
+  if len(allCompletions) > 0:
+    forecast["jobsPerHour"] = completionRate(min(allExecuted), allCompletions, alpha) * 3600
+  for name in order:
+    summary = summaries[name]
+    if summary["SUBMITTED"] != None and summary["done"] < summary["JOBS"]:
+      forecast["currentStage"] = name
+      if summary["TYPE"] == "individual" and summary["RATE"] != None:
+        #Each job of a stage covers JOBS/scans of the cohort, e.g. a batch of scans for the scalar maps.
+        forecast["scansPerHour"] = summary["RATE"] * 3600 * stagesInfo["scans"] / summary["JOBS"]
+  if len(finishes) == len(order) and status in ["running", "finished"]:
+    eta = {}
+    for bound in bounds.keys():
+      eta[bound] = max([finish[bound] for finish in finishes.values()])
+    forecast["eta"] = {"finish":timeString(eta["est"]), "low":timeString(eta["low"]), "high":timeString(eta["high"]), "hoursLeft":max(eta["est"] - now, 0.0) / 3600.0}
+  for name in order:
+    summary = summaries[name]
+    stage = {"name":name, "category":summary["CATEGORY"], "type":summary["TYPE"], "jobs":summary["JOBS"],
+             "done":summary["done"], "running":summary["running"], "idle":summary["idle"], "held":summary["held"], "failed":summary["failed"],
+             "started":timeString(summary["SUBMITTED"]), "jobsPerHour":None,
+             "predictedFinish":None, "predictedFinishLow":None, "predictedFinishHigh":None}
+    if summary["RATE"] != None:
+      stage["jobsPerHour"] = summary["RATE"] * 3600
+    if name in finishes:
+      stage["predictedFinish"] = timeString(finishes[name]["est"])
+      stage["predictedFinishLow"] = timeString(finishes[name]["low"])
+      stage["predictedFinishHigh"] = timeString(finishes[name]["high"])
+    forecast["stages"].append(stage)
+  return forecast
+
+def timeString(stamp):
+  if stamp == None:
+    return None
+  return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(stamp))
+
+def writeForecast(forecastFile, forecast):
+  #Write to a temporary file first, so the monitor page never reads half a forecast.
+  with open("{0}.tmp".format(forecastFile), "w") as tmpFile:
+    tmpFile.write(json.dumps(forecast, indent=1, sort_keys=True))
+  os.rename("{0}.tmp".format(forecastFile), forecastFile)
+
+#============================================================================
+#============ Main ==========================================================
+
+def go(args):
+  arguments = docopt(doc, argv=args)
+  ScriptsDir = arguments["<script_output_dir>"].rstrip("/")
+  MonitorDir = arguments["<monitor_dir>"].rstrip("/")
+  alpha = float(arguments["--alpha"])
+  interval = float(arguments["--interval"])
+  forecastFile = "{0}/{1}".format(MonitorDir, arguments["--output"])
+  stagesFile = "{0}/condorsubmit/DAG_DTITK.stages.json".format(ScriptsDir)
+  if not os.path.exists(stagesFile):
+    print("Stages file '{0}' does not exist! Was the setup run with this script output directory? Exiting now.".format(stagesFile))
+    sys.exit(1)
+  with open(stagesFile) as stagesInput:
+    stagesInfo = json.load(stagesInput)
+  stages = set([stage["NAME"] for stage in stagesInfo["stages"]])
+
+  nodes = {}
+  while True:
+    now = time.time()
+    readLogs(ScriptsDir, stages, nodes, now)
+    forecast = createForecast(stagesInfo, nodes, alpha, now)
+    writeForecast(forecastFile, forecast)
+    line = "{0}: {1}, {2} of {3} jobs done".format(forecast["generated"], forecast["status"], forecast["jobs"]["done"], forecast["jobs"]["total"])
+    if forecast["eta"] != None:
+      line = line + ", ETA {0} ({1} to {2})".format(forecast["eta"]["finish"], forecast["eta"]["low"], forecast["eta"]["high"])
+    print(line)
+    if arguments["--once"] or forecast["status"] == "finished":
+      break
+    time.sleep(interval)
+
+if __name__ == '__main__':
+    args = sys.argv
+    del args[0]
+    go(args)
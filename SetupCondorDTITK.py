@@ -52,13 +52,46 @@ Options:
   --rigid=<rigidcount>    Number of rigid iterations [default: 3]
   --affine=<affinecount>  Number of affine iterations [default: 3]
   --diffeo=<diffeocount>  Number of diffeomorphic iterations [default: 6]
+  --tolerance=<tol>       Convergence tolerance of the diffeomorphic registration [default: 0.002]
+  --sweep=<sweepfile>     A csv file of diffeomorphic settings to compare, with headers NAME, ITERATIONS and TOLERANCE. The rigid and affine stages are run once and shared by every setting.
+  --vsize=<vsize>         Target voxel size (mm) of the bootstrap template. Defaults to a per-species value.
+  --fov=<fov>             Field of view (mm) of the cohort as X,Y,Z. Skips reading the geometry from the scans.
+  --grid=<grid>           Rounding of the bootstrap grid size (either POW2 or SMOOTH) [default: POW2]
+  --cache=<cachedir>      Directory to cache rigid and affine registration results in, so they can be reused across runs.
+  --cachesize=<size>      Size cap of the registration cache in MB [default: 10240]
+  --maxjobs=<maxjobs>     Maximum number of running jobs per DAG category, as comma separated CATEGORY=COUNT pairs. Categories are rigid, affine, diffeo, maps and group (e.g. rigid=500,diffeo=200).
+  --concurrency=<limit>   HTCondor concurrency limit to attach to the group steps, which read every scan from the file server.
+  --maps=<maps>           Comma separated scalar maps to compute from the normalized scans after the last diffeomorphic step (any of FA, MD, TR, AD and RD), along with a mean FA mask and skeleton.
+  --mapbatch=<mapbatch>   Number of scans per scalar map job [default: 20]
+  --verbose               Also report every scan, submit file and DAG job as it is created.
+  --quiet                 Only report warnings and errors.
   """
 
+#The setup can also be used from Python. createPlan builds the whole pipeline in memory, without touching
+#the script, normalization or monitor directories, and materialize writes a plan out:
+#
+#  import SetupCondorDTITK
+#  arguments = SetupCondorDTITK.makeArguments(["--species=MONKEY", "subjects.csv", "/apps/dtitk", "scripts", "norm"])
+#  plan = SetupCondorDTITK.createPlan(arguments)
+#  SetupCondorDTITK.materialize(plan)
+#
+#A plan is a dictionary with the scans, the diffeomorphic variants, the DAG stages, nodes and edges, the contents
+#of every file to write, and the directories and links to create. Progress is reported through the
+#"SetupCondorDTITK" logger: phases at INFO, individual scans, files and jobs at DEBUG, and problems at WARNING.
+
 #============================================================================
 #============ Importing things ==============================================
 
-import os, sys, glob, shutil, csv, random, subprocess, math
-from docopt import docopt
+import os, sys, glob, shutil, csv, math, hashlib, time, logging, json, gzip, struct
+from collections import OrderedDict
+from docopt import docopt, DocoptExit
+
+log = logging.getLogger("SetupCondorDTITK")
+log.addHandler(logging.NullHandler())
+
+class SetupError(Exception):
+    #Raised for problems with the inputs, so that callers of the API can handle them. The command line reports them and exits.
+    pass
 
 #============================================================================
 #============ Argument Parsing and Cleanup ==================================
@@ -85,7 +118,20 @@ def cleanArguments(arguments):
     cleanArg["RigidIterationMax"] = int(arguments["--rigid"])
     cleanArg["AffineIterationMax"] = int(arguments["--affine"])
     cleanArg["DiffeomorphicIterationMax"] = int(arguments["--diffeo"])
-    cleanArg["scriptHeader"] = "#!/bin/bash\n#Utilizing elements created by Gary Hui Zhang (garyhuizhang@gmail.com), see credits in main script.\n#Adapted for use in HTCondor and DAG by Andrew Schoen (schoen.andrewj@gmail.com)\n#\n. {0}/scripts/dtitk_common.sh\nexport DTITK_ROOT={0}".format(arguments["<dtitk_root>"])
+    cleanArg["DiffeomorphicTolerance"] = parseTolerance(arguments["--tolerance"], "--tolerance")
+    if arguments["--sweep"]:
+      cleanArg["SweepFile"] = arguments["--sweep"]
+    else:
+      cleanArg["SweepFile"] = False
+    cleanArg["gridMode"] = arguments["--grid"].upper()
+    if cleanArg["gridMode"] not in ["POW2", "SMOOTH"]:
+        log.warning("The grid input '{0}' did not match one of the existing options. Defaulting to 'POW2'.".format(cleanArg["gridMode"]))
+        cleanArg["gridMode"] = "POW2"
+    if arguments["--fov"]:
+        cleanArg["fov"] = parsePositiveNumbers(arguments["--fov"], 3, "--fov")
+    else:
+        cleanArg["fov"] = False
+    cleanArg["scriptHeader"] = "#!/bin/bash\n#Utilizing elements created by Gary Hui Zhang (garyhuizhang@gmail.com), see credits in main script.\n#Adapted for use in HTCondor and DAG by Andrew Schoen (schoen.andrewj@gmail.com)\n#\n. {0}/scripts/dtitk_common.sh\nexport DTITK_ROOT={0}\n. {1}/dtitk_condor_helpers.sh".format(arguments["<dtitk_root>"], cleanArg["ScriptsDir"])
     if cleanArg["ShouldMonitor"] == True:
       cleanArg["MonitorDir"] = arguments["<monitor_dir>"]
       if cleanArg["MonitorDir"].endswith("/"):
@@ -93,60 +139,112 @@ def cleanArguments(arguments):
         cleanArg["MonitorDir"] = argString[:-1]
     else:
       cleanArg["MonitorDir"] = False
+    if arguments["--cache"]:
+      cleanArg["CacheDir"] = arguments["--cache"]
+      if cleanArg["CacheDir"].endswith("/"):
+        argString = cleanArg["CacheDir"]
+        cleanArg["CacheDir"] = argString[:-1]
+    else:
+      cleanArg["CacheDir"] = False
+    cleanArg["CacheSizeMB"] = parseCount(arguments["--cachesize"], "--cachesize")
+    cleanArg["MaxJobs"] = {}
+    if arguments["--maxjobs"]:
+      for pair in arguments["--maxjobs"].split(","):
+        if pair.count("=") != 1:
+          raise SetupError("--maxjobs takes CATEGORY=COUNT pairs, not '{0}'.".format(pair))
+        category, count = pair.split("=")
+        category = category.strip().lower()
+        if category not in ["rigid", "affine", "diffeo", "maps", "group"]:
+          raise SetupError("The DAG category '{0}' is not one of rigid, affine, diffeo, maps and group.".format(category))
+        cleanArg["MaxJobs"][category] = parseCount(count, "The --maxjobs count of {0}".format(category))
+    cleanArg["Maps"] = []
+    if arguments["--maps"]:
+      for scalarMap in arguments["--maps"].split(","):
+        scalarMap = scalarMap.strip().upper()
+        if scalarMap not in ["FA", "MD", "TR", "AD", "RD"]:
+          raise SetupError("The scalar map '{0}' is not one of FA, MD, TR, AD and RD.".format(scalarMap))
+        if scalarMap not in cleanArg["Maps"]:
+          cleanArg["Maps"].append(scalarMap)
+    cleanArg["MapBatchSize"] = parseCount(arguments["--mapbatch"], "--mapbatch")
+    if arguments["--concurrency"]:
+      cleanArg["ConcurrencyLimit"] = arguments["--concurrency"]
+    else:
+      cleanArg["ConcurrencyLimit"] = False
     if cleanArg["species"] == "MONKEY":
         cleanArg["sep_coarse"] = 2
         cleanArg["sep_fine"] = 1
+        cleanArg["vsize"] = 1
     elif cleanArg["species"] == "RAT":
         cleanArg["sep_coarse"] = 0.4
         cleanArg["sep_fine"] = 0.2
+        cleanArg["vsize"] = 0.2
     elif cleanArg["species"] == "HUMAN":
         cleanArg["sep_coarse"] = 4
         cleanArg["sep_fine"] = 2
+        cleanArg["vsize"] = 2
     else:
-        print("WARNING: The species input '{0}' did not match one of the existing options. Defaulting to 'HUMAN' settings.".format(cleanArg["species"]))
+        log.warning("The species input '{0}' did not match one of the existing options. Defaulting to 'HUMAN' settings.".format(cleanArg["species"]))
         cleanArg["sep_coarse"] = 4
         cleanArg["sep_fine"] = 2
+        cleanArg["vsize"] = 2
+    if arguments["--vsize"]:
+        cleanArg["vsize"] = parsePositiveNumbers(arguments["--vsize"], 1, "--vsize")[0]
     
     return cleanArg
 
+def parsePositiveNumbers(text, count, description):
+    #Comma separated numbers above 0, such as the X,Y,Z field of view.
+    try:
+      numbers = [float(value) for value in text.split(",")]
+    except ValueError:
+      numbers = []
+    if len(numbers) != count or min(numbers) <= 0:
+      if count == 1:
+        raise SetupError("{0} must be a number above 0, not '{1}'.".format(description, text))
+      raise SetupError("{0} must be {1} comma separated numbers above 0, not '{2}'.".format(description, count, text))
+    return numbers
+
+def makeArguments(args):
+    #Parse command line style arguments (e.g. ["--rigid=2", "subjects.csv", ...]) into the cleaned arguments taken by createPlan.
+    try:
+      arguments = docopt(doc, argv=args, help=False)
+    except DocoptExit as error:
+      raise SetupError(str(error))
+    return cleanArguments(arguments)
+
 def printInputs(argumentsDict):
-    print("Inputs:")
+    log.info("Inputs:")
     for key,value in argumentsDict.items():
-        print("{0} = {1}".format(key, value))
+        log.info("{0} = {1}".format(key, value))
 
 
 #============================================================================
 #============File Writing Utility============================================
 
-#Let's Create some functions to write to our files
-
-def writeRowToFile(text, filename):
-    file = open(filename, 'a')
-    file.write("{0}\n".format(text))
-    file.close
-
-def writeContinuedRowToFile(text, filename):
-    file = open(filename, 'a')
-    file.write("{0}".format(text))
-    file.close
-    
-#============================================================================
-#============System Calling Utility==========================================
+#Let's Create some functions to write to our files.
+#The rows are collected in the plan that is being created, and written out by materialize.
 
-#Create a shorthand for running system processes, such as FSL commands
+def writeRowToFile(text, filename, plan):
+    writeContinuedRowToFile("{0}\n".format(text), filename, plan)
 
-def systemCall(command):
-    p = subprocess.Popen([command], stdout=subprocess.PIPE, shell=True)
-    return p.stdout.read()
+def writeContinuedRowToFile(text, filename, plan):
+    row = "{0}".format(text)
+    plan["files"].setdefault(filename, []).append(row)
+    plan["bytes"] = plan["bytes"] + len(row)
 
+def writeFile(filename, contents):
+    file = open(filename, 'w')
+    file.write(contents)
+    file.close()
+    
 #============================================================================
 #============Script and Normalization Directories============================
 
 def createDir(Dir):
   if os.path.exists(Dir):
-      print("Directory '{0}' already exists".format(Dir))
+      log.info("Directory '{0}' already exists".format(Dir))
   else:
-      print("Directory '{0}' does not exist. Creating now.".format(Dir))
+      log.info("Directory '{0}' does not exist. Creating now.".format(Dir))
       os.mkdir(Dir)
 
 #============================================================================
@@ -154,24 +252,69 @@ def createDir(Dir):
 
 def cleanUpNormFromPrev(NormDir):
   #Remove anything currently in the normalization directory, so we can start fresh.
-  print "Removing anything currently in the normalization directory, so we can start fresh."
+  log.info("Removing anything currently in the normalization directory, so we can start fresh.")
+  #Only the sweep working directories and the output directory are ours to remove; any other directory stops the setup before anything is deleted.
   filelist = glob.glob("{0}/*".format(NormDir))
   for file in filelist:
-      os.remove(file)
+      if os.path.isdir(file) and not os.path.islink(file) and not isNormSubDir(file):
+          raise SetupError("The normalization directory '{0}' contains the directory '{1}', which was not created by this setup. Move it elsewhere, or choose another normalization directory.".format(NormDir, os.path.basename(file)))
+  for file in filelist:
+      if os.path.isdir(file) and not os.path.islink(file):
+          shutil.rmtree(file)
+      else:
+          os.remove(file)
+
+def isNormSubDir(Dir):
+  #The directories the setup creates in the normalization directory: one per sweep setting, and the results of an unswept run.
+  name = os.path.basename(Dir)
+  return name.startswith("sweep_") or name == "output"
 
 def cleanUpScriptsFromPrev(ScriptsDir):
   #Remove any previous scripts currently in the scripts directory, so we can start fresh.
-  print "Removing any previous scripts currently in the scripts directory, so we can start fresh."
+  log.info("Removing any previous scripts currently in the scripts directory, so we can start fresh.")
   filelist = glob.glob("{0}/*.sh".format(ScriptsDir))
   for file in filelist:
       os.remove(file)
 
+#============================================================================
+#============Registration Cache==============================================
+
+def dtitkFingerprint(DTITK_ROOT):
+  #Identify the DTI-TK install by the names, sizes and modification times of its tools.
+  #Cached registrations are only reused by the same install.
+  fingerprint = hashlib.sha1()
+  for tool in sorted(glob.glob("{0}/bin/*".format(DTITK_ROOT)) + glob.glob("{0}/scripts/*".format(DTITK_ROOT))):
+      toolStat = os.stat(tool)
+      fingerprint.update("{0} {1} {2}\n".format(os.path.basename(tool), toolStat.st_size, int(toolStat.st_mtime)))
+  return fingerprint.hexdigest()
+
+def reportCache(CacheDir):
+  #Summarize the hits and misses recorded by previous runs.
+  hits = 0
+  misses = 0
+  if os.path.exists("{0}/stats.log".format(CacheDir)):
+    with open("{0}/stats.log".format(CacheDir)) as statsFile:
+      for line in statsFile:
+        fields = line.split()
+        if len(fields) > 1 and fields[1] == "hit":
+          hits = hits + 1
+        elif len(fields) > 1 and fields[1] == "miss":
+          misses = misses + 1
+  entries = len(glob.glob("{0}/entries/*".format(CacheDir)))
+  log.info("Registration cache '{0}': {1} entries, {2} hits, {3} misses so far.".format(CacheDir, entries, hits, misses))
+
+def cacheWrap(command, stage, parameters, inputs, outputs, CacheDir):
+  #Route a registration command through the cache helper, if caching is enabled.
+  if CacheDir == False:
+    return command
+  return 'cache_run {0} "{1}" "{2}" "{3}" {4}'.format(stage, parameters, inputs, outputs, command)
+
 #============================================================================
 #============Condor Sub-Directory Creation===================================
 
 def createSubDir(DirRoot, type):
   #Create a place to put the condor submit files and logs.
-  print("Creating a place to put the {0}.".format(type))
+  log.info("Creating a place to put the {0}.".format(type))
 
   if os.path.exists("{0}/{1}".format(DirRoot, type)):
       if os.path.exists("{0}/{1}_archived".format(DirRoot, type)):
@@ -185,12 +328,11 @@ def createSubDir(DirRoot, type):
 
 def parseCSV(csvfilepath):
     if os.path.exists(csvfilepath):
-      print("Parsing CSV File '{0}'.".format(csvfilepath))
+      log.info("Parsing CSV File '{0}'.".format(csvfilepath))
       with open(csvfilepath) as csvfile:
         firstline = csvfile.readline()
         if firstline != "ID,PATH\n":
-          print("CSV File does not contain the correct header. It should be two-column CSV with headers of ID and PATH")
-          sys.exit(1)
+          raise SetupError("CSV File does not contain the correct header. It should be two-column CSV with headers of ID and PATH")
         csvfile.seek(0)
         reader = csv.DictReader(csvfile)
         scans=[]
@@ -199,71 +341,210 @@ def parseCSV(csvfilepath):
         
         return scans
     else:
-        print("CSV File '{0}' does not exist! Exiting now.".format(csvfilepath))
-        sys.exit(1)
+        raise SetupError("CSV File '{0}' does not exist! Exiting now.".format(csvfilepath))
+
+def parseSweepCSV(csvfilepath):
+    if os.path.exists(csvfilepath):
+      log.info("Parsing Sweep CSV File '{0}'.".format(csvfilepath))
+      with open(csvfilepath) as csvfile:
+        firstline = csvfile.readline()
+        if firstline != "NAME,ITERATIONS,TOLERANCE\n":
+          raise SetupError("Sweep CSV File does not contain the correct header. It should be three-column CSV with headers of NAME, ITERATIONS and TOLERANCE")
+        csvfile.seek(0)
+        reader = csv.DictReader(csvfile)
+        settings=[]
+        names=[]
+        for setting in reader:
+            if not setting["NAME"].replace("_", "").replace("-", "").isalnum():
+              raise SetupError("Sweep setting name '{0}' may only contain letters, numbers, '-' and '_'.".format(setting["NAME"]))
+            if setting["NAME"] in names:
+              raise SetupError("Sweep setting name '{0}' is used more than once.".format(setting["NAME"]))
+            names.append(setting["NAME"])
+            setting["ITERATIONS"] = parseCount(setting["ITERATIONS"], "Sweep setting '{0}' ITERATIONS".format(setting["NAME"]))
+            setting["TOLERANCE"] = parseTolerance(setting["TOLERANCE"], "Sweep setting '{0}' TOLERANCE".format(setting["NAME"]))
+            settings.append(setting)
+        
+        return settings
+    else:
+        raise SetupError("Sweep CSV File '{0}' does not exist! Exiting now.".format(csvfilepath))
+
+def parseCount(value, description):
+    #A whole number of at least 1, such as an iteration count.
+    try:
+      count = int(value)
+    except (TypeError, ValueError):
+      raise SetupError("{0} must be a whole number, not '{1}'.".format(description, value))
+    if count < 1:
+      raise SetupError("{0} must be at least 1, not {1}.".format(description, count))
+    return count
+
+def parseTolerance(value, description):
+    #A positive number, which is pasted into the generated registration commands.
+    try:
+      tolerance = float(value)
+    except (TypeError, ValueError):
+      raise SetupError("{0} must be a number, not '{1}'.".format(description, value))
+    if not tolerance > 0:
+      raise SetupError("{0} must be above 0, not {1}.".format(description, value))
+    return tolerance
+
+#============================================================================
+#============Diffeomorphic Variants==========================================
+
+def createDiffeoVariants(arguments):
+    #Each variant is one diffeomorphic branch of the DAG, run in its own working directory.
+    #Without a sweep there is a single variant, run in the normalization directory itself.
+    variants = []
+    if arguments["SweepFile"] == False:
+      variants.append({"NAME":"", "ITERATIONS":arguments["DiffeomorphicIterationMax"], "TOLERANCE":arguments["DiffeomorphicTolerance"], "SUFFIX":"", "NormDir":arguments["NormDir"]})
+    else:
+      for setting in parseSweepCSV(arguments["SweepFile"]):
+        setting["SUFFIX"] = "_{0}".format(setting["NAME"])
+        setting["NormDir"] = "{0}/sweep_{1}".format(arguments["NormDir"], setting["NAME"])
+        variants.append(setting)
+        log.info("Sweep setting {0}: {1} iterations, tolerance {2}".format(setting["NAME"], setting["ITERATIONS"], setting["TOLERANCE"]))
+    return variants
+
+def variantLinks(scans, VariantDir):
+  #List the links of the shared affine results into a sweep working directory, as (source, link) pairs
+  log.info("Linking the affine results into '{0}'".format(VariantDir))
+  links = []
+  for scan in scans:
+      id=scan["ID"]
+      links.append(("../{0}_spd_aff.nii.gz".format(id), "{0}/{1}_spd_aff.nii.gz".format(VariantDir, id)))
+      links.append(("../{0}_spd.aff".format(id), "{0}/{1}_spd.aff".format(VariantDir, id)))
+  links.append(("../mask.nii.gz", "{0}/mask.nii.gz".format(VariantDir)))
+  links.append(("../mean_diffeomorphic0.nii.gz", "{0}/mean_diffeomorphic0.nii.gz".format(VariantDir)))
+  links.append(("mean_diffeomorphic0.nii.gz", "{0}/mean_diffeomorphic_initial.nii.gz".format(VariantDir)))
+  return links
 
 #============================================================================
 #============Define Additional Dimension Variables===========================
 
+def readScanGeometry(scanID, scanPath):
+    #Read the dimensions and voxel sizes of a scan from its NIfTI-1 header, in process rather than with an FSL call per scan.
+    #Only the first 348 bytes are read, so a gzipped scan is barely decompressed.
+    try:
+        with open(scanPath, "rb") as scanFile:
+            gzipped = scanFile.read(2) == "\x1f\x8b"
+        if gzipped:
+            scanFile = gzip.open(scanPath, "rb")
+        else:
+            scanFile = open(scanPath, "rb")
+        try:
+            header = scanFile.read(348)
+        finally:
+            scanFile.close()
+    except (IOError, EOFError) as error:
+        raise SetupError("Could not read the header of scan {0} ('{1}'): {2}".format(scanID, scanPath, error))
+    
+    #sizeof_hdr is 348, in the byte order the header was written in
+    for byteOrder in ["<", ">"]:
+        if len(header) == 348 and struct.unpack("{0}i".format(byteOrder), header[0:4])[0] == 348:
+            dims = struct.unpack("{0}8h".format(byteOrder), header[40:56])
+            pixdims = struct.unpack("{0}8f".format(byteOrder), header[76:108])
+            if dims[0] < 3 or min(dims[1:4]) < 1:
+                break
+            geometry = {}
+            for axis in range(1,4):
+                geometry["dim{0}".format(axis)] = float(dims[axis])
+                geometry["pixdim{0}".format(axis)] = float(pixdims[axis])
+            return geometry
+    raise SetupError("Could not read the dimensions and voxel sizes of scan {0} ('{1}'). Is it a NIfTI-1 file?".format(scanID, scanPath))
+
+def fftFriendlySize(count, gridMode):
+    #Round a voxel count up to a size the FFT-based registration handles well.
+    #POW2 gives the next power of two, SMOOTH the next number with no prime factors above 5.
+    size = 1
+    while size < count:
+        size = size * 2
+    if gridMode == "SMOOTH":
+        candidate = max(int(math.ceil(count)), 1)
+        while candidate < size:
+            remainder = candidate
+            for factor in [2, 3, 5]:
+                while remainder % factor == 0:
+                    remainder = remainder // factor
+            if remainder == 1:
+                return candidate
+            candidate = candidate + 1
+    return size
+
 def addDimVars(scans, arguments):
-    randomScan = random.choice(scans)
-    randomScanID = randomScan["ID"]
-    randomScanPath = randomScan["PATH"]
-    print("Randomly selected scan {0} ({1}) to define dimensions for bootstrapping.".format(randomScanID, randomScanPath))
-    if glob.glob("/apps/fsl*"):
-        print("Using FSL to determine the dimensions of your output file.")
-        xdim = float(systemCall('fslval {0} dim1'.format(randomScanPath)))
-        ydim = float(systemCall('fslval {0} dim2'.format(randomScanPath)))
-        zdim = float(systemCall('fslval {0} dim3'.format(randomScanPath)))
-        xpixdim = float(systemCall('fslval {0} pixdim1'.format(randomScanPath)))
-        ypixdim = float(systemCall('fslval {0} pixdim2'.format(randomScanPath)))
-        zpixdim = float(systemCall('fslval {0} pixdim3'.format(randomScanPath)))
-        
-        #Add the calculated values to arguments
-        arguments["xsize"] = math.ceil(xdim * xpixdim / 64)
-        arguments["ysize"] = math.ceil(ydim * ypixdim / 64)
-        arguments["zsize"] = math.ceil(zdim * zpixdim / 64)
+    if arguments["fov"]:
+        log.info("Using the field of view given on the command line to define dimensions for bootstrapping.")
+        fov = arguments["fov"]
     else:
-        print("You do not have FSL installed. Please enter in the voxel dimensions of your output file manually")
-        arguments["xsize"] = float(input("Voxel Size in the X dimension: "))
-        arguments["ysize"] = float(input("Voxel Size in the Y dimension: "))
-        arguments["zsize"] = float(input("Voxel Size in the Z dimension: "))
+        log.info("Reading the field of view of your cohort from the scan headers.")
+        fov = [0.0, 0.0, 0.0]
+        for scan in scans:
+            geometry = readScanGeometry(scan["ID"], scan["PATH"])
+            for axis in range(0,3):
+                axisFov = geometry["dim{0}".format(axis + 1)] * abs(geometry["pixdim{0}".format(axis + 1)])
+                fov[axis] = max(fov[axis], axisFov)
+    log.info("Cohort field of view: {0} x {1} x {2} mm".format(fov[0], fov[1], fov[2]))
+    
+    #Add the calculated values to arguments
+    arguments["xsize"] = arguments["vsize"]
+    arguments["ysize"] = arguments["vsize"]
+    arguments["zsize"] = arguments["vsize"]
+    arguments["xgrid"] = fftFriendlySize(fov[0] / arguments["vsize"], arguments["gridMode"])
+    arguments["ygrid"] = fftFriendlySize(fov[1] / arguments["vsize"], arguments["gridMode"])
+    arguments["zgrid"] = fftFriendlySize(fov[2] / arguments["vsize"], arguments["gridMode"])
     return arguments
 
+def reportGrid(arguments, scanCount):
+    #Estimate what the chosen bootstrap grid costs, relative to the old fixed 128x128x64 grid.
+    #A tensor volume holds 6 floats per voxel and a deformation field 3 floats per voxel.
+    voxels = arguments["xgrid"] * arguments["ygrid"] * arguments["zgrid"]
+    legacyVoxels = 128 * 128 * 64
+    tensorMB = voxels * 6 * 4 / 1048576.0
+    fieldMB = voxels * 3 * 4 / 1048576.0
+    #A diffeomorphic registration keeps the template, the subject and about three vector fields in memory.
+    registrationMB = 2 * tensorMB + 3 * fieldMB
+    relativeCost = (voxels * math.log(voxels, 2)) / (legacyVoxels * math.log(legacyVoxels, 2))
+    log.info("Bootstrap grid: {0} x {1} x {2} voxels of {3} x {4} x {5} mm".format(arguments["xgrid"], arguments["ygrid"], arguments["zgrid"], arguments["xsize"], arguments["ysize"], arguments["zsize"]))
+    log.info("Tensor volume size: {0:.1f} MB".format(tensorMB))
+    log.info("Deformation field size: {0:.1f} MB".format(fieldMB))
+    log.info("Expected memory per diffeomorphic registration: {0:.1f} MB".format(registrationMB))
+    log.info("Expected data read per group mean: {0:.1f} MB".format(scanCount * tensorMB))
+    log.info("Expected cost per iteration relative to a 128 x 128 x 64 grid: {0:.2f}x".format(relativeCost))
+
 #============================================================================
 #============Subject List Creation===========================================
 
-def createScanLists(scans, NormDir):
+def createScanLists(plan, scans, NormDir):
   #Add subject to lists for processing
-  print "Creating scan list files."
+  log.info("Creating scan list files.")
 
   for scan in scans:
       id=scan["ID"]
-      writeRowToFile("{0}_spd.nii.gz".format(id), "{0}/scan_list_file.txt".format(NormDir))
-      print("Scan {0} added to scan_list_file.txt".format(id))
+      writeRowToFile("{0}_spd.nii.gz".format(id), "{0}/scan_list_file.txt".format(NormDir), plan)
+      log.debug("Scan {0} added to scan_list_file.txt".format(id))
     
-      writeRowToFile("{0}_spd_aff.nii.gz".format(id), "{0}/scan_list_file_aff.txt".format(NormDir))
-      print("Scan {0} added to scan_list_file_aff.txt".format(id))
+      writeRowToFile("{0}_spd_aff.nii.gz".format(id), "{0}/scan_list_file_aff.txt".format(NormDir), plan)
+      log.debug("Scan {0} added to scan_list_file_aff.txt".format(id))
     
-      writeRowToFile("{0}_spd_aff_diffeo.nii.gz".format(id), "{0}/scan_list_file_aff_diffeo.txt".format(NormDir))
-      print("Scan {0} added to scan_list_file_aff_diffeo.txt".format(id))
+      writeRowToFile("{0}_spd_aff_diffeo.nii.gz".format(id), "{0}/scan_list_file_aff_diffeo.txt".format(NormDir), plan)
+      log.debug("Scan {0} added to scan_list_file_aff_diffeo.txt".format(id))
     
-      writeRowToFile("{0}_spd.aff".format(id), "{0}/affine.txt".format(NormDir))
-      print("Scan {0} added to affine.txt".format(id))
+      writeRowToFile("{0}_spd.aff".format(id), "{0}/affine.txt".format(NormDir), plan)
+      log.debug("Scan {0} added to affine.txt".format(id))
     
-      writeRowToFile("{0}_spd_aff_diffeo.df.nii.gz".format(id), "{0}/diffeo.txt".format(NormDir))
-      print("Scan {0} added to diffeo.txt".format(id))
+      writeRowToFile("{0}_spd_aff_diffeo.df.nii.gz".format(id), "{0}/diffeo.txt".format(NormDir), plan)
+      log.debug("Scan {0} added to diffeo.txt".format(id))
 
-  print "Scan list files created."
+  log.info("Scan list files created.")
 
-def linkScans(scans, NormDir):
-  #Link to the subject's relevant files from the normalization directory you specified
+def scanLinks(scans, NormDir):
+  #List the links to the subject's relevant files from the normalization directory you specified, as (source, link) pairs
+  links = []
   for scan in scans:
       id=scan["ID"]
       path=scan["PATH"]
-      print("Linking Scan {0} files in the Normalization Directory".format(id))
-      os.symlink(path, "{0}/{1}_spd.nii.gz".format(NormDir, id))
-      print("Scan {0} files linked in the Normalization Directory".format(id))
+      log.debug("Linking Scan {0} files in the Normalization Directory".format(id))
+      links.append((path, "{0}/{1}_spd.nii.gz".format(NormDir, id)))
+  return links
 
 def createJobObjForMonitor(scans):
   jobs = []
@@ -275,9 +556,9 @@ def createJobObjForMonitor(scans):
 #============================================================================
 #============Script List Creation============================================
 
-def createIndividualScriptsList(RigidIterationMax, AffineIterationMax, DiffeomorphicIterationMax):
+def createIndividualScriptsList(RigidIterationMax, AffineIterationMax):
     #Create a list of individual processes
-    print "Creating a list of the different individual scripts to be run."
+    log.info("Creating a list of the different individual scripts to be run.")
 
     #Create an empty array.
     individualScriptList = list()
@@ -292,17 +573,12 @@ def createIndividualScriptsList(RigidIterationMax, AffineIterationMax, Diffeomor
     for iteration in range(1,AffineUpperBound):
         individualScriptList.append("Individual_Affine{0}A".format(iteration))
         individualScriptList.append("Individual_Affine{0}B".format(iteration))
-
-    #Diffeomorphic Step (variable numbers)
-    DiffeomorphicUpperBound = DiffeomorphicIterationMax + 1
-    for iteration in range(1,DiffeomorphicUpperBound):
-       individualScriptList.append("Individual_Diffeomorphic{0}".format(iteration))
     
     return individualScriptList
   
-def createGroupScriptsList(RigidIterationMax, AffineIterationMax, DiffeomorphicIterationMax):
+def createGroupScriptsList(RigidIterationMax, AffineIterationMax):
   #Create a list of group processes
-  print "Creating a list of the different group scripts to be run."
+  log.info("Creating a list of the different group scripts to be run.")
   
   #Create an empty array.
   groupScriptList = list()
@@ -320,15 +596,50 @@ def createGroupScriptsList(RigidIterationMax, AffineIterationMax, DiffeomorphicI
   for iteration in range(1,AffineUpperBound):
       groupScriptList.append("Group_Affine{0}A".format(iteration))
       groupScriptList.append("Group_Affine{0}B".format(iteration))
+  
+  return groupScriptList
+
+def createDiffeomorphicScriptsLists(DiffeomorphicIterationMax, suffix):
+  #Create the lists of individual and group processes for one diffeomorphic variant, and the order they run in.
+  individualScriptList = list()
+  groupScriptList = list()
+  chain = list()
 
   #Diffeomorphic Step (variable numbers)
   DiffeomorphicUpperBound = DiffeomorphicIterationMax + 1
   for iteration in range(1,DiffeomorphicUpperBound):
-      groupScriptList.append("Group_Diffeomorphic{0}".format(iteration))
+      individualScriptList.append("Individual_Diffeomorphic{0}{1}".format(iteration, suffix))
+      chain.append("Individual_Diffeomorphic{0}{1}".format(iteration, suffix))
+      groupScriptList.append("Group_Diffeomorphic{0}{1}".format(iteration, suffix))
+      chain.append("Group_Diffeomorphic{0}{1}".format(iteration, suffix))
   
-  return groupScriptList
-
-def createEventObjForMonitor(RigidIterationMax, AffineIterationMax, DiffeomorphicIterationMax):
+  return groupScriptList, individualScriptList, chain
+
+def createMapScriptsLists(suffix):
+  #Create the lists of individual and group processes that derive scalar maps for one diffeomorphic variant
+  individualScriptList = ["Individual_Maps{0}".format(suffix)]
+  groupScriptList = ["Group_Maps{0}".format(suffix)]
+  chain = ["Individual_Maps{0}".format(suffix), "Group_Maps{0}".format(suffix)]
+  return groupScriptList, individualScriptList, chain
+
+def createMapBatches(scans, MapBatchSize):
+  #Scalar maps are quick to compute, so each job works through a batch of scans, passed as its arguments.
+  batches = []
+  for start in range(0, len(scans), MapBatchSize):
+      batchScans = scans[start:start + MapBatchSize]
+      batches.append({"ID":"MapBatch{0}".format(len(batches) + 1), "ARGUMENTS":" ".join([scan["ID"] for scan in batchScans])})
+  return batches
+
+def createChain(groupScriptList, individualScriptList):
+  #Order the group and individual processes of the rigid and affine stages, which simply alternate.
+  chain = list()
+  for step in range(0,len(individualScriptList)):
+      chain.append(groupScriptList[step])
+      chain.append(individualScriptList[step])
+  chain.append(groupScriptList[-1])
+  return chain
+
+def createEventObjForMonitor(RigidIterationMax, AffineIterationMax, variants, ShouldMap):
   events = []
   
   events.append({"ID":"B", "NAME":"Bootstrap"})
@@ -341,106 +652,292 @@ def createEventObjForMonitor(RigidIterationMax, AffineIterationMax, Diffeomorphi
   for iteration in range(1,AffineUpperBound):
     events.append({"ID":"A{0}A".format(iteration), "NAME":"Affine {0}A".format(iteration)})
     events.append({"ID":"A{0}B".format(iteration), "NAME":"Affine {0}B".format(iteration)})
-    
-  DiffeomorphicUpperBound = DiffeomorphicIterationMax + 1
-  for iteration in range(1,DiffeomorphicUpperBound):
-    events.append({"ID":"D{0}".format(iteration), "NAME":"Diffeo {0}".format(iteration)})
+  
+  for variant in variants:
+    DiffeomorphicUpperBound = variant["ITERATIONS"] + 1
+    for iteration in range(1,DiffeomorphicUpperBound):
+      if variant["NAME"] == "":
+        events.append({"ID":"D{0}".format(iteration), "NAME":"Diffeo {0}".format(iteration)})
+      else:
+        events.append({"ID":"D{0}{1}".format(iteration, variant["SUFFIX"]), "NAME":"Diffeo {0} ({1})".format(iteration, variant["NAME"])})
+    if ShouldMap == True:
+      if variant["NAME"] == "":
+        events.append({"ID":"M", "NAME":"Maps"})
+      else:
+        events.append({"ID":"M{0}".format(variant["SUFFIX"]), "NAME":"Maps ({0})".format(variant["NAME"])})
   
   return events
 
 #============================================================================
 #============Condor Submit File Creation - Individual Processes==============
 
-def createSubmitIndiv(ScriptsDir, NormDir, individualScriptList, scans):
+def createSubmitIndiv(plan, ScriptsDir, NormDir, individualScriptList, scans):
   #Create the condor_submit files for individual processes.
   for scan in scans:
-      print("Individual Submit files for {0}".format(scan["ID"]))
+      log.debug("Individual Submit files for {0}".format(scan["ID"]))
       for script in individualScriptList:
-          print("Current Process: {0}".format(script))
+          log.debug("Current Process: {0}".format(script))
           currentSubmit="{0}/condorsubmit/cs_{1}_{2}.condor".format(ScriptsDir, scan["ID"], script)
-          writeRowToFile("Universe=vanilla", currentSubmit)
-          writeRowToFile("initialdir={0}".format(NormDir), currentSubmit)
-          writeRowToFile("getenv=True", currentSubmit)
-          writeRowToFile("request_memory=1024", currentSubmit)
-          writeRowToFile("Executable={0}/{1}.sh".format(ScriptsDir, script), currentSubmit)
-          writeRowToFile("Log={0}/condorlogs/{1}_{2}_log.txt".format(ScriptsDir, scan["ID"], script), currentSubmit)
-          writeRowToFile("Output={0}/condorlogs/{1}_{2}_out.txt".format(ScriptsDir, scan["ID"], script), currentSubmit)
-          writeRowToFile("Error={0}/condorlogs/{1}_{2}_err.txt".format(ScriptsDir, scan["ID"], script), currentSubmit)
-          writeRowToFile("Notification=NEVER", currentSubmit)
-          writeRowToFile("Arguments={0}".format(scan["ID"]), currentSubmit)
-          writeRowToFile("Queue", currentSubmit)
+          writeRowToFile("Universe=vanilla", currentSubmit, plan)
+          writeRowToFile("initialdir={0}".format(NormDir), currentSubmit, plan)
+          writeRowToFile("getenv=True", currentSubmit, plan)
+          writeRowToFile("request_memory=1024", currentSubmit, plan)
+          writeRowToFile("Executable={0}/{1}.sh".format(ScriptsDir, script), currentSubmit, plan)
+          writeRowToFile("Log={0}/condorlogs/{1}_{2}_log.txt".format(ScriptsDir, scan["ID"], script), currentSubmit, plan)
+          writeRowToFile("Output={0}/condorlogs/{1}_{2}_out.txt".format(ScriptsDir, scan["ID"], script), currentSubmit, plan)
+          writeRowToFile("Error={0}/condorlogs/{1}_{2}_err.txt".format(ScriptsDir, scan["ID"], script), currentSubmit, plan)
+          writeRowToFile("Notification=NEVER", currentSubmit, plan)
+          writeRowToFile("Arguments={0}".format(scan.get("ARGUMENTS", scan["ID"])), currentSubmit, plan)
+          writeRowToFile("Queue", currentSubmit, plan)
 
 #============================================================================
 #============Condor Submit File Creation - Group Processes===================
 
-def createSubmitGrp(ScriptsDir, NormDir, groupScriptList):
+def createSubmitGrp(plan, ScriptsDir, NormDir, groupScriptList, ConcurrencyLimit):
   #Create the condor_submit files for group processes.
-  print("Group Submit files for all subjects")
+  log.info("Group Submit files for all subjects")
   for script in groupScriptList:
-      print("Current Process: {0}".format(script))
+      log.debug("Current Process: {0}".format(script))
       currentSubmit="{0}/condorsubmit/cs_{1}.condor".format(ScriptsDir, script)
-      writeRowToFile("Universe=vanilla", currentSubmit)
-      writeRowToFile("initialdir={0}".format(NormDir), currentSubmit)
-      writeRowToFile("getenv=True", currentSubmit)
-      writeRowToFile("request_memory=1024", currentSubmit)
-      writeRowToFile("Executable={0}/{1}.sh".format(ScriptsDir, script), currentSubmit)
-      writeRowToFile("Log={0}/condorlogs/{1}_log.txt".format(ScriptsDir, script), currentSubmit)
-      writeRowToFile("Output={0}/condorlogs/{1}_out.txt".format(ScriptsDir, script), currentSubmit)
-      writeRowToFile("Error={0}/condorlogs/{1}_err.txt".format(ScriptsDir, script), currentSubmit)
-      writeRowToFile("Notification=NEVER", currentSubmit)
-      writeRowToFile("Queue", currentSubmit)
+      writeRowToFile("Universe=vanilla", currentSubmit, plan)
+      writeRowToFile("initialdir={0}".format(NormDir), currentSubmit, plan)
+      writeRowToFile("getenv=True", currentSubmit, plan)
+      writeRowToFile("request_memory=1024", currentSubmit, plan)
+      writeRowToFile("Executable={0}/{1}.sh".format(ScriptsDir, script), currentSubmit, plan)
+      writeRowToFile("Log={0}/condorlogs/{1}_log.txt".format(ScriptsDir, script), currentSubmit, plan)
+      writeRowToFile("Output={0}/condorlogs/{1}_out.txt".format(ScriptsDir, script), currentSubmit, plan)
+      writeRowToFile("Error={0}/condorlogs/{1}_err.txt".format(ScriptsDir, script), currentSubmit, plan)
+      writeRowToFile("Notification=NEVER", currentSubmit, plan)
+      if ConcurrencyLimit != False:
+        writeRowToFile("concurrency_limits={0}".format(ConcurrencyLimit), currentSubmit, plan)
+      writeRowToFile("Queue", currentSubmit, plan)
 
 #============================================================================
 #============DAGMan File Creation============================================
 
-def createDAG(ScriptsDir, groupScriptList, individualScriptList, scans):
+def createDAGNodes(ScriptsDir, chains, scans, batches):
+  #List the DAG jobs: each group process once, and each individual process once per scan, unless batches lists other jobs for it.
+  #Every node gets a category and a critical path priority.
+  priorities = computeStagePriorities(chains)
+  allGroupScripts, allIndividualScripts = splitChainScripts(chains)
+  nodes = []
+  for script in allGroupScripts:
+      nodes.append({"NAME":script, "SCRIPT":script, "SCAN":"Group", "SUBMIT":"{0}/condorsubmit/cs_{1}.condor".format(ScriptsDir, script), "CATEGORY":nodeCategory(script), "PRIORITY":priorities[script]})
+  for script in allIndividualScripts:
+      log.debug("Current script = {0}".format(script))
+      for scan in batches.get(script, scans):
+          node = {"NAME":"{0}_{1}".format(scan["ID"], script), "SCRIPT":script, "SCAN":scan["ID"], "SUBMIT":"{0}/condorsubmit/cs_{1}_{2}.condor".format(ScriptsDir, scan["ID"], script), "CATEGORY":nodeCategory(script), "PRIORITY":priorities[script]}
+          nodes.append(node)
+  return nodes
+
+def createDAGEdges(chains, scans, batches):
+  #List the dependencies, each making every one of its PARENTS a parent of every one of its CHILDREN.
+  #An individual step fans out from the group step before it and joins into the one after it.
+  #Consecutive individual steps follow each other scan by scan.
+  edges = []
+  for chain in chains:
+    for step in range(0,len(chain) - 1):
+      CurrentParent = chain[step]
+      CurrentChild = chain[step + 1]
+    
+      if CurrentParent.startswith("Group_"):
+          edges.append({"PARENTS":[CurrentParent], "CHILDREN":["{0}_{1}".format(scan["ID"], CurrentChild) for scan in batches.get(CurrentChild, scans)]})
+      elif CurrentChild.startswith("Group_"):
+          edges.append({"PARENTS":["{0}_{1}".format(scan["ID"], CurrentParent) for scan in batches.get(CurrentParent, scans)], "CHILDREN":[CurrentChild]})
+      else:
+          for scan in scans:
+              edges.append({"PARENTS":["{0}_{1}".format(scan["ID"], CurrentParent)], "CHILDREN":["{0}_{1}".format(scan["ID"], CurrentChild)]})
+  return edges
+
+def createStages(nodes):
+  #Summarize the nodes per process, in the order the processes first appear.
+  stages = OrderedDict()
+  for node in nodes:
+      if node["SCRIPT"] not in stages:
+          stages[node["SCRIPT"]] = {"NAME":node["SCRIPT"], "CATEGORY":node["CATEGORY"], "PRIORITY":node["PRIORITY"], "JOBS":0}
+          stages[node["SCRIPT"]]["TYPE"] = "group" if node["SCRIPT"].startswith("Group_") else "individual"
+      stages[node["SCRIPT"]]["JOBS"] = stages[node["SCRIPT"]]["JOBS"] + 1
+  return stages.values()
+
+def createDAG(plan, ScriptsDir, nodes, edges, MaxJobs):
   #Create the DAGMan file for putting it all together.
-  print("Creating the DAG File.")
+  log.info("Creating the DAG File.")
   dagFile="{0}/condorsubmit/DAG_DTITK.dag".format(ScriptsDir)
 
-  writeRowToFile("#File name: DAG_DTITK.dag", dagFile)
-  writeRowToFile("#", dagFile)
+  writeRowToFile("#File name: DAG_DTITK.dag", dagFile, plan)
+  writeRowToFile("#", dagFile, plan)
 
   #Declaring Jobs
-
-  #Group Components
-  print("Group Components")
-  writeRowToFile("#Group Components", dagFile)
-  for script in groupScriptList:
-      writeRowToFile("JOB {0} {1}/condorsubmit/cs_{0}.condor".format(script, ScriptsDir), dagFile)
-    
-  #Individual Components
-  print("Individual Components")
-  writeRowToFile("#Individual Components", dagFile)
-  for script in individualScriptList:
-      print("Current script = {0}".format(script))
-      for scan in scans:
-          writeRowToFile("JOB {0}_{1} {2}/condorsubmit/cs_{0}_{1}.condor".format(scan["ID"], script, ScriptsDir), dagFile)
+  log.info("Group Components")
+  writeRowToFile("#Group Components", dagFile, plan)
+  for node in nodes:
+      if node["SCAN"] == "Group":
+          writeRowToFile("JOB {0} {1}".format(node["NAME"], node["SUBMIT"]), dagFile, plan)
+  log.info("Individual Components")
+  writeRowToFile("#Individual Components", dagFile, plan)
+  for node in nodes:
+      if node["SCAN"] != "Group":
+          writeRowToFile("JOB {0} {1}".format(node["NAME"], node["SUBMIT"]), dagFile, plan)
 
   #Dependencies
-  print("Dependencies")
-  writeRowToFile("#Dependencies", dagFile)
-  stepUpperBound = len(individualScriptList)
-  for step in range(0,stepUpperBound):
-      CurrentParent = groupScriptList[step]
-      CurrentTask = individualScriptList[step]
-      CurrentChild = groupScriptList[step + 1]
-    
-      writeContinuedRowToFile("PARENT {0} CHILD".format(CurrentParent), dagFile)
-      for scan in scans:
-          writeContinuedRowToFile(" ", dagFile)
-          writeContinuedRowToFile("{0}_{1}".format(scan["ID"], CurrentTask), dagFile)
-      writeRowToFile(" ", dagFile)
-
-      writeContinuedRowToFile("PARENT", dagFile)
-      for scan in scans:
-          writeContinuedRowToFile(" ", dagFile)
-          writeContinuedRowToFile("{0}_{1}".format(scan["ID"], CurrentTask), dagFile)
-      writeRowToFile(" CHILD {0}".format(CurrentChild), dagFile)
-
-  print("DTITK DAG Setup -> COMPLETE")
+  log.info("Dependencies")
+  writeRowToFile("#Dependencies", dagFile, plan)
+  for edge in edges:
+      writeRowToFile("PARENT {0} CHILD {1}".format(" ".join(edge["PARENTS"]), " ".join(edge["CHILDREN"])), dagFile, plan)
+
+  #Scheduling Policy
+  log.info("Scheduling Policy")
+  writeRowToFile("#Categories and Priorities", dagFile, plan)
+  for node in nodes:
+      writeRowToFile("CATEGORY {0} {1}".format(node["NAME"], node["CATEGORY"]), dagFile, plan)
+      writeRowToFile("PRIORITY {0} {1}".format(node["NAME"], node["PRIORITY"]), dagFile, plan)
+  if len(MaxJobs) > 0:
+    writeRowToFile("#Throttling", dagFile, plan)
+    for category in sorted(MaxJobs.keys()):
+        writeRowToFile("MAXJOBS {0} {1}".format(category, MaxJobs[category]), dagFile, plan)
+
+  log.info("DTITK DAG Setup -> COMPLETE")
+
+def splitChainScripts(chains):
+  #List the group and the individual processes of all chains, each once, in the order they first appear.
+  allGroupScripts = list()
+  allIndividualScripts = list()
+  for chain in chains:
+      for script in chain:
+          if script.startswith("Group_"):
+              if script not in allGroupScripts:
+                  allGroupScripts.append(script)
+          elif script not in allIndividualScripts:
+              allIndividualScripts.append(script)
+  return allGroupScripts, allIndividualScripts
+
+def createStagesFile(plan, ScriptsDir, scans, stages, chains):
+  #Describe the stages and the order they run in for ForecastCondorDTITK.py, which predicts when they finish from the condor logs.
+  stagesFile="{0}/condorsubmit/DAG_DTITK.stages.json".format(ScriptsDir)
+  writeRowToFile(json.dumps({"version":Version, "scans":len(scans), "stages":stages, "chains":chains}, indent=1, sort_keys=True), stagesFile, plan)
 
+#============================================================================
+#============DAGMan Scheduling Policy========================================
+
+def nodeCategory(script):
+  #Throttling category of a script: all group steps share one, individual steps are grouped by stage.
+  #Only the prefix is matched, since sweep names are appended to the diffeomorphic and map scripts.
+  if script.startswith("Group_"):
+    return "group"
+  elif script.startswith("Individual_Rigid"):
+    return "rigid"
+  elif script.startswith("Individual_Affine"):
+    return "affine"
+  elif script.startswith("Individual_Maps"):
+    return "maps"
+  elif script.startswith("Individual_Diffeomorphic"):
+    return "diffeo"
+  raise ValueError("No DAG category for process '{0}'".format(script))
+
+def computeStagePriorities(chains):
+  #Priority of each script is the number of steps left from it to the end of the longest path through the DAG,
+  #so DAGMan submits the steps on the critical path (e.g. the longest sweep branch) first.
+  children = {}
+  for chain in chains:
+    for step in range(0,len(chain) - 1):
+      children.setdefault(chain[step], []).append(chain[step + 1])
+  
+  priorities = {}
+  def remainingSteps(script):
+    if script not in priorities:
+      priorities[script] = 1 + max([0] + [remainingSteps(child) for child in children.get(script, [])])
+    return priorities[script]
+  for chain in chains:
+    for script in chain:
+      remainingSteps(script)
+  return priorities
 
+#============================================================================
+#============Script Creation - Shared Helpers================================
+
+#Shell functions sourced by every generated script
+def writeHelpers(plan, ScriptsDir, DTITK_ROOT, CacheDir, CacheSizeMB):
+    currentScript="{0}/dtitk_condor_helpers.sh".format(ScriptsDir)
+    writeRowToFile("#!/bin/bash", currentScript, plan)
+    writeRowToFile("#Shared functions for the DTITK Condor scripts. Sourced from the script header.", currentScript, plan)
+    writeRowToFile("", currentScript, plan)
+    writeRowToFile("#Registration cache, keyed by the content of the inputs, the stage, the tool parameters and the DTI-TK install.", currentScript, plan)
+    if CacheDir == False:
+      writeRowToFile("DTITK_CACHE_DIR=''", currentScript, plan)
+      writeRowToFile("DTITK_CACHE_VERSION=''", currentScript, plan)
+    else:
+      writeRowToFile("DTITK_CACHE_DIR='{0}'".format(CacheDir), currentScript, plan)
+      writeRowToFile("DTITK_CACHE_VERSION='{0}'".format(dtitkFingerprint(DTITK_ROOT)), currentScript, plan)
+    writeRowToFile("DTITK_CACHE_SIZE_MB={0}".format(CacheSizeMB), currentScript, plan)
+    writeRowToFile("""
+#cache_run <stage> "<parameters>" "<input files>" "<output files>" <command...>
+#Reuses the outputs of an identical earlier registration, or runs the command and stores its outputs.
+cache_run() {
+  local stage=$1 parameters=$2 inputs=$3 outputs=$4
+  shift 4
+  if [[ -z $DTITK_CACHE_DIR ]] ; then
+    "$@"
+    return $?
+  fi
+  mkdir -p ${DTITK_CACHE_DIR}/entries
+  local key=$( { echo "${stage} ${parameters} ${DTITK_CACHE_VERSION}" ; cat ${inputs} | sha1sum ; } | sha1sum | cut -d' ' -f1 )
+  local entry=${DTITK_CACHE_DIR}/entries/${key}
+  local index output
+  if [[ -d $entry ]] ; then
+    index=0
+    for output in ${outputs} ; do
+      #Copy rather than hard-link, since later steps rewrite some outputs in place.
+      cp --reflink=auto ${entry}/${index} ${output} || break
+      index=$((index+1))
+    done
+    if [[ $index == $(echo ${outputs} | wc -w) ]] ; then
+      touch ${entry}
+      echo "$(date +%s) hit ${stage} ${key}" >> ${DTITK_CACHE_DIR}/stats.log
+      return 0
+    fi
+  fi
+  echo "$(date +%s) miss ${stage} ${key}" >> ${DTITK_CACHE_DIR}/stats.log
+  "$@" || return $?
+  local staging=$(mktemp -d ${DTITK_CACHE_DIR}/entries/.staging.XXXXXX)
+  index=0
+  for output in ${outputs} ; do
+    cp --reflink=auto ${output} ${staging}/${index}
+    index=$((index+1))
+  done
+  mv -T ${staging} ${entry} 2>/dev/null || rm -rf ${staging}
+  cache_evict
+  return 0
+}
+
+#Remove the least recently used entries until the cache fits in DTITK_CACHE_SIZE_MB.
+cache_evict() {
+  (
+    flock -n 9 || exit 0
+    local total=$(du -sm ${DTITK_CACHE_DIR}/entries | cut -f1)
+    local oldest
+    while [[ $total -gt $DTITK_CACHE_SIZE_MB ]] ; do
+      oldest=$(ls -1tr ${DTITK_CACHE_DIR}/entries | head -n 1)
+      if [[ -z $oldest ]] ; then
+        break
+      fi
+      total=$((total - $(du -sm ${DTITK_CACHE_DIR}/entries/${oldest} | cut -f1)))
+      rm -rf ${DTITK_CACHE_DIR}/entries/${oldest}
+    done
+  ) 9>${DTITK_CACHE_DIR}/.evict.lock
+}
+
+#link_file <source> <destination>
+#Gives a file that is still needed a second name without copying its data: a hard link where possible,
+#otherwise a reflink copy on filesystems that support it, otherwise a plain copy.
+link_file() {
+  ln -fL $1 $2 2>/dev/null || cp --reflink=auto $1 $2
+}""", currentScript, plan)
+
+def linkCommand(source, destination, reused):
+    #Rename a file that nothing reads afterwards, and link one that is still needed.
+    if reused == True:
+      return "link_file {0} {1}".format(source, destination)
+    return "mv -f {0} {1}".format(source, destination)
 
 #============================================================================
 #============Script Creation - Group Processes===============================
@@ -449,441 +946,663 @@ def createDAG(ScriptsDir, groupScriptList, individualScriptList, scans):
 #scriptHeader = "#!/bin/bash\n#Utilizing elements created by Gary Hui Zhang (garyhuizhang@gmail.com), see credits in main script.\n#Adapted for use in HTCondor and DAG by Andrew Schoen (schoen.andrewj@gmail.com)\n#\n. {0}/scripts/dtitk_common.sh\nexport DTITK_ROOT={0}".format(DTITK_ROOT)
 
 #Script generation for Step 1: Bootstrapping
-def writeStep1(ScriptsDir, scriptHeader, xsize, ysize, zsize, ShouldMonitor, MonitorDir):
+def writeStep1(plan, ScriptsDir, scriptHeader, xsize, ysize, zsize, xgrid, ygrid, zgrid, ShouldMonitor, MonitorDir, ShouldKeep):
     currentScript="{0}/Group_Bootstrap.sh".format(ScriptsDir)
-    writeRowToFile(scriptHeader, currentScript)
-    writeRowToFile("echo 'DTI Step 1: Bootstrapping for all scans'", currentScript)
+    writeRowToFile(scriptHeader, currentScript, plan)
+    writeRowToFile("echo 'DTI Step 1: Bootstrapping for all scans'", currentScript, plan)
     if ShouldMonitor == True:
-      writeRowToFile("{0}/statusupdate.py Group B Running".format(MonitorDir), currentScript)
+      writeRowToFile("{0}/statusupdate.py Group B Running".format(MonitorDir), currentScript, plan)
       #Step 1
-      writeRowToFile("errcount=0", currentScript)
-      writeRowToFile("if TVMean -in scan_list_file.txt -out dti_mean_initial.nii.gz ; then", currentScript)
-      writeRowToFile("  errcount=expr $errcount+0", currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  echo 'There was an error with TVMean'", currentScript)
-      writeRowToFile("  errcount=expr $errcount+1", currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("errcount=0", currentScript, plan)
+      writeRowToFile("if TVMean -in scan_list_file.txt -out dti_mean_initial.nii.gz ; then", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+0", currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  echo 'There was an error with TVMean'", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+1", currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
       #Step 2
-      writeRowToFile("if TVResample -in dti_mean_initial.nii.gz -vsize {0} {1} {2} -size 128 128 64 ; then".format(xsize, ysize, zsize), currentScript)
-      writeRowToFile("  errcount=expr $errcount+0", currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  echo 'There was an error with TVResample'", currentScript)
-      writeRowToFile("  errcount=expr $errcount+1", currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("if TVResample -in dti_mean_initial.nii.gz -vsize {0} {1} {2} -size {3} {4} {5} ; then".format(xsize, ysize, zsize, xgrid, ygrid, zgrid), currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+0", currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  echo 'There was an error with TVResample'", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+1", currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
       #Error check and Update
-      writeRowToFile("if [[ $errcount == 0 ]] ; then", currentScript)
-      writeRowToFile("  {0}/statusupdate.py Group B Finished".format(MonitorDir), currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  {0}/statusupdate.py Group B Error".format(MonitorDir), currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("if [[ $errcount == 0 ]] ; then", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py Group B Finished".format(MonitorDir), currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py Group B Error".format(MonitorDir), currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
     else:
-      writeRowToFile("TVMean -in scan_list_file.txt -out dti_mean_initial.nii.gz", currentScript)
-      writeRowToFile("TVResample -in dti_mean_initial.nii.gz -vsize {0} {1} {2} -size 128 128 64".format(xsize, ysize, zsize), currentScript)
-    writeRowToFile("cp dti_mean_initial.nii.gz mean_rigid0.nii.gz", currentScript)
-    writeRowToFile("echo 'DTI Step 1: Bootstrapping for all scans -> COMPLETE!'", currentScript)
+      writeRowToFile("TVMean -in scan_list_file.txt -out dti_mean_initial.nii.gz", currentScript, plan)
+      writeRowToFile("TVResample -in dti_mean_initial.nii.gz -vsize {0} {1} {2} -size {3} {4} {5}".format(xsize, ysize, zsize, xgrid, ygrid, zgrid), currentScript, plan)
+    writeRowToFile(linkCommand("dti_mean_initial.nii.gz", "mean_rigid0.nii.gz", ShouldKeep), currentScript, plan)
+    writeRowToFile("echo 'DTI Step 1: Bootstrapping for all scans -> COMPLETE!'", currentScript, plan)
 
 #Script generation for Step 2: Rigid Normalization (Individual Steps)
-def writeStep2Iter(iter, iterMax, ScriptsDir, scriptHeader, DTITK_ROOT, regType, sep_coarse, ShouldMonitor, MonitorDir):
+def writeStep2Iter(plan, iter, iterMax, ScriptsDir, scriptHeader, DTITK_ROOT, regType, sep_coarse, ShouldMonitor, MonitorDir, CacheDir):
     prevIter= iter - 1
     currentScript="{0}/Individual_Rigid{1}.sh".format(ScriptsDir, iter)
-    writeRowToFile(scriptHeader, currentScript)
-    writeRowToFile("scan=$1", currentScript)
-    writeRowToFile('echo "Current Scan: ${scan}"', currentScript)
-    writeRowToFile("echo 'DTI Step 2.{0}: Rigid Alignment, Iteration {0}'".format(iter), currentScript)
+    writeRowToFile(scriptHeader, currentScript, plan)
+    writeRowToFile("scan=$1", currentScript, plan)
+    writeRowToFile('echo "Current Scan: ${scan}"', currentScript, plan)
+    writeRowToFile("echo 'DTI Step 2.{0}: Rigid Alignment, Iteration {0}'".format(iter), currentScript, plan)
+    if iter == 1:
+      command = "{0}/scripts/dti_rigid_reg mean_rigid{1}.nii.gz ${{scan}}_spd.nii.gz {2} {3} {3} {3} 0.01".format(DTITK_ROOT, prevIter, regType, sep_coarse)
+      command = cacheWrap(command, "rigid", "{0} {1} 0.01".format(regType, sep_coarse), "mean_rigid{0}.nii.gz ${{scan}}_spd.nii.gz".format(prevIter), "${scan}_spd.aff ${scan}_spd_aff.nii.gz", CacheDir)
+    else:
+      command = "{0}/scripts/dti_rigid_reg mean_rigid{1}.nii.gz ${{scan}}_spd.nii.gz {2} {3} {3} {3} 0.01 1".format(DTITK_ROOT, prevIter, regType, sep_coarse)
+      command = cacheWrap(command, "rigid", "{0} {1} 0.01 1".format(regType, sep_coarse), "mean_rigid{0}.nii.gz ${{scan}}_spd.nii.gz ${{scan}}_spd.aff".format(prevIter), "${scan}_spd.aff ${scan}_spd_aff.nii.gz", CacheDir)
     if ShouldMonitor == True:
-      writeRowToFile("{0}/statusupdate.py ${{scan}} R{1} Running".format(MonitorDir, iter), currentScript)
-      if iter == 1:
-        writeRowToFile("if {0}/scripts/dti_rigid_reg mean_rigid{1}.nii.gz ${{scan}}_spd.nii.gz {2} {3} {3} {3} 0.01 ; then".format(DTITK_ROOT, prevIter, regType, sep_coarse), currentScript)
-      else:
-        writeRowToFile("if {0}/scripts/dti_rigid_reg mean_rigid{1}.nii.gz ${{scan}}_spd.nii.gz {2} {3} {3} {3} 0.01 1 ; then".format(DTITK_ROOT, prevIter, regType, sep_coarse), currentScript)
-      writeRowToFile("  {0}/statusupdate.py ${{scan}} R{1} Finished".format(MonitorDir, iter), currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  {0}/statusupdate.py ${{scan}} R{1} Error".format(MonitorDir, iter), currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("{0}/statusupdate.py ${{scan}} R{1} Running".format(MonitorDir, iter), currentScript, plan)
+      writeRowToFile("if {0} ; then".format(command), currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py ${{scan}} R{1} Finished".format(MonitorDir, iter), currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py ${{scan}} R{1} Error".format(MonitorDir, iter), currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
     else:
-      if iter == 1:
-        writeRowToFile("{0}/scripts/dti_rigid_reg mean_rigid{1}.nii.gz ${{scan}}_spd.nii.gz {2} {3} {3} {3} 0.01".format(DTITK_ROOT, prevIter, regType, sep_coarse), currentScript)
-      else:
-        writeRowToFile("{0}/scripts/dti_rigid_reg mean_rigid{1}.nii.gz ${{scan}}_spd.nii.gz {2} {3} {3} {3} 0.01 1".format(DTITK_ROOT, prevIter, regType, sep_coarse), currentScript)
-    writeRowToFile("echo 'DTI Step 2.{0}: Rigid Alignment, Iteration {0} -> COMPLETE!'".format(iter), currentScript)
+      writeRowToFile(command, currentScript, plan)
+    writeRowToFile("echo 'DTI Step 2.{0}: Rigid Alignment, Iteration {0} -> COMPLETE!'".format(iter), currentScript, plan)
 
 #Script generation for Step 3a: Affine Normalization (Individual Steps)
-def writeStep3IterA(iter, iterMax, ScriptsDir, scriptHeader, DTITK_ROOT, regType, sep_coarse, ShouldMonitor, MonitorDir):
+def writeStep3IterA(plan, iter, iterMax, ScriptsDir, scriptHeader, DTITK_ROOT, regType, sep_coarse, ShouldMonitor, MonitorDir, CacheDir):
     prevIter= iter - 1
     currentScript="{0}/Individual_Affine{1}A.sh".format(ScriptsDir, iter)
-    writeRowToFile(scriptHeader, currentScript)
-    writeRowToFile("scan=$1", currentScript)
-    writeRowToFile('echo "Current Scan: ${scan}"', currentScript)
-    writeRowToFile("echo 'DTI Step 3.{0}a: Affine Alignment, Iteration {0}, Part A'".format(iter), currentScript)
+    writeRowToFile(scriptHeader, currentScript, plan)
+    writeRowToFile("scan=$1", currentScript, plan)
+    writeRowToFile('echo "Current Scan: ${scan}"', currentScript, plan)
+    writeRowToFile("echo 'DTI Step 3.{0}a: Affine Alignment, Iteration {0}, Part A'".format(iter), currentScript, plan)
+    command = "{0}/scripts/dti_affine_reg mean_affine{1}.nii.gz ${{scan}}_spd.nii.gz {2} {3} {3} {3} 0.01 1".format(DTITK_ROOT, prevIter, regType, sep_coarse)
+    command = cacheWrap(command, "affine", "{0} {1} 0.01 1".format(regType, sep_coarse), "mean_affine{0}.nii.gz ${{scan}}_spd.nii.gz ${{scan}}_spd.aff".format(prevIter), "${scan}_spd.aff ${scan}_spd_aff.nii.gz", CacheDir)
     if ShouldMonitor == True:
-      writeRowToFile("{0}/statusupdate.py ${{scan}} A{1}A Running".format(MonitorDir, iter), currentScript)
-      writeRowToFile("if {0}/scripts/dti_affine_reg mean_affine{1}.nii.gz ${{scan}}_spd.nii.gz {2} {3} {3} {3} 0.01 1 ; then".format(DTITK_ROOT, prevIter, regType, sep_coarse), currentScript)
-      writeRowToFile("  {0}/statusupdate.py ${{scan}} A{1}A Finished".format(MonitorDir, iter), currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  {0}/statusupdate.py ${{scan}} A{1}A Error".format(MonitorDir, iter), currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("{0}/statusupdate.py ${{scan}} A{1}A Running".format(MonitorDir, iter), currentScript, plan)
+      writeRowToFile("if {0} ; then".format(command), currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py ${{scan}} A{1}A Finished".format(MonitorDir, iter), currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py ${{scan}} A{1}A Error".format(MonitorDir, iter), currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
     else:
-      writeRowToFile("{0}/scripts/dti_affine_reg mean_affine{1}.nii.gz ${{scan}}_spd.nii.gz {2} {3} {3} {3} 0.01 1".format(DTITK_ROOT, prevIter, regType, sep_coarse), currentScript)
-    writeRowToFile("echo 'DTI Step 3.{0}a: Affine Alignment, Iteration {0}, Part A -> COMPLETE!'".format(iter), currentScript)
+      writeRowToFile(command, currentScript, plan)
+    writeRowToFile("echo 'DTI Step 3.{0}a: Affine Alignment, Iteration {0}, Part A -> COMPLETE!'".format(iter), currentScript, plan)
 
 #Script generation for Step 3b: Affine Normalization (Individual Steps)
-def writeStep3IterB(iter, iterMax, ScriptsDir, scriptHeader, ShouldMonitor, MonitorDir):
+def writeStep3IterB(plan, iter, iterMax, ScriptsDir, scriptHeader, ShouldMonitor, MonitorDir):
     prevIter= iter - 1
     currentScript="{0}/Individual_Affine{1}B.sh".format(ScriptsDir, iter)
-    writeRowToFile(scriptHeader, currentScript)
-    writeRowToFile("scan=$1", currentScript)
-    writeRowToFile('echo "Current Scan: ${scan}"', currentScript)
-    writeRowToFile("echo 'DTI Step 3.{0}b: Affine Alignment, Iteration {0}, Part B'".format(iter), currentScript)
+    writeRowToFile(scriptHeader, currentScript, plan)
+    writeRowToFile("scan=$1", currentScript, plan)
+    writeRowToFile('echo "Current Scan: ${scan}"', currentScript, plan)
+    writeRowToFile("echo 'DTI Step 3.{0}b: Affine Alignment, Iteration {0}, Part B'".format(iter), currentScript, plan)
     if ShouldMonitor == True:
-      writeRowToFile("{0}/statusupdate.py ${{scan}} A{1}B Running".format(MonitorDir, iter), currentScript)
+      writeRowToFile("{0}/statusupdate.py ${{scan}} A{1}B Running".format(MonitorDir, iter), currentScript, plan)
       #Step 1
-      writeRowToFile("errcount=0", currentScript)
-      writeRowToFile("if affine3Dtool -in ${scan}_spd.aff -compose average_inv.aff -out ${scan}_spd.aff ; then", currentScript)
-      writeRowToFile("  errcount=expr $errcount+0".format(MonitorDir, iter), currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  echo 'There was an error with affine3Dtool'", currentScript)
-      writeRowToFile("  errcount=expr $errcount+1".format(MonitorDir, iter), currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("errcount=0", currentScript, plan)
+      writeRowToFile("if affine3Dtool -in ${scan}_spd.aff -compose average_inv.aff -out ${scan}_spd.aff ; then", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+0".format(MonitorDir, iter), currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  echo 'There was an error with affine3Dtool'", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+1".format(MonitorDir, iter), currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
       #Step 2
-      writeRowToFile("if affineSymTensor3DVolume -in ${{scan}}_spd.nii.gz -trans ${{scan}}_spd.aff -target mean_affine{0}.nii.gz -out ${{scan}}_spd_aff.nii.gz ; then".format(prevIter), currentScript)
-      writeRowToFile("  errcount=expr $errcount+0".format(MonitorDir, iter), currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  echo 'There was an error with affineSymTensor3DVolume'", currentScript)
-      writeRowToFile("  errcount=expr $errcount+1".format(MonitorDir, iter), currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("if affineSymTensor3DVolume -in ${{scan}}_spd.nii.gz -trans ${{scan}}_spd.aff -target mean_affine{0}.nii.gz -out ${{scan}}_spd_aff.nii.gz ; then".format(prevIter), currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+0".format(MonitorDir, iter), currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  echo 'There was an error with affineSymTensor3DVolume'", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+1".format(MonitorDir, iter), currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
       #Error check and Update
-      writeRowToFile("if [[ $errcount == 0 ]] ; then", currentScript)
-      writeRowToFile("  {0}/statusupdate.py ${{scan}} A{1}B Finished".format(MonitorDir, iter), currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  {0}/statusupdate.py ${{scan}} A{1}B Error".format(MonitorDir, iter), currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("if [[ $errcount == 0 ]] ; then", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py ${{scan}} A{1}B Finished".format(MonitorDir, iter), currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py ${{scan}} A{1}B Error".format(MonitorDir, iter), currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
     else:
-      writeRowToFile("affine3Dtool -in ${scan}_spd.aff -compose average_inv.aff -out ${scan}_spd.aff", currentScript)
-      writeRowToFile("affineSymTensor3DVolume -in ${{scan}}_spd.nii.gz -trans ${{scan}}_spd.aff -target mean_affine{0}.nii.gz -out ${{scan}}_spd_aff.nii.gz".format(prevIter), currentScript)
-    writeRowToFile("echo 'DTI Step 3.{0}b: Affine Alignment, Iteration {0}, Part B -> COMPLETE!'".format(iter), currentScript)
+      writeRowToFile("affine3Dtool -in ${scan}_spd.aff -compose average_inv.aff -out ${scan}_spd.aff", currentScript, plan)
+      writeRowToFile("affineSymTensor3DVolume -in ${{scan}}_spd.nii.gz -trans ${{scan}}_spd.aff -target mean_affine{0}.nii.gz -out ${{scan}}_spd_aff.nii.gz".format(prevIter), currentScript, plan)
+    writeRowToFile("echo 'DTI Step 3.{0}b: Affine Alignment, Iteration {0}, Part B -> COMPLETE!'".format(iter), currentScript, plan)
 
 #Script generation for Step 4: Diffeomorphic Normalization (Individual Steps)
-def writeStep4Iter(iter, iterMax, ScriptsDir, scriptHeader, DTITK_ROOT, ShouldMonitor, MonitorDir):
+def writeStep4Iter(plan, iter, iterMax, ScriptsDir, scriptHeader, DTITK_ROOT, tolerance, suffix, ShouldMonitor, MonitorDir):
     prevIter= iter - 1
-    currentScript="{0}/Individual_Diffeomorphic{1}.sh".format(ScriptsDir, iter)
-    writeRowToFile(scriptHeader, currentScript)
-    writeRowToFile("scan=$1", currentScript)
-    writeRowToFile('echo "Current Scan: ${scan}"', currentScript)
-    writeRowToFile("echo 'DTI Step 4.{0}: Diffeomorphic Alignment, Iteration {0}'".format(iter), currentScript)
+    currentScript="{0}/Individual_Diffeomorphic{1}{2}.sh".format(ScriptsDir, iter, suffix)
+    writeRowToFile(scriptHeader, currentScript, plan)
+    writeRowToFile("scan=$1", currentScript, plan)
+    writeRowToFile('echo "Current Scan: ${scan}"', currentScript, plan)
+    writeRowToFile("echo 'DTI Step 4.{0}: Diffeomorphic Alignment, Iteration {0}'".format(iter), currentScript, plan)
     if ShouldMonitor == True:
-      writeRowToFile("{0}/statusupdate.py ${{scan}} D{1} Running".format(MonitorDir, iter), currentScript)
-      writeRowToFile("if {0}/scripts/dti_diffeomorphic_reg mean_diffeomorphic_initial.nii.gz ${{scan}}_spd_aff.nii.gz mask.nii.gz 1 {1} 0.002 ; then".format(DTITK_ROOT, iter), currentScript)
-      writeRowToFile("  {0}/statusupdate.py ${{scan}} D{1} Finished".format(MonitorDir, iter), currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  {0}/statusupdate.py ${{scan}} D{1} Error".format(MonitorDir, iter), currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("{0}/statusupdate.py ${{scan}} D{1}{2} Running".format(MonitorDir, iter, suffix), currentScript, plan)
+      writeRowToFile("if {0}/scripts/dti_diffeomorphic_reg mean_diffeomorphic_initial.nii.gz ${{scan}}_spd_aff.nii.gz mask.nii.gz 1 {1} {2} ; then".format(DTITK_ROOT, iter, tolerance), currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py ${{scan}} D{1}{2} Finished".format(MonitorDir, iter, suffix), currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py ${{scan}} D{1}{2} Error".format(MonitorDir, iter, suffix), currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
     else:
-      writeRowToFile("{0}/scripts/dti_diffeomorphic_reg mean_diffeomorphic_initial.nii.gz ${{scan}}_spd_aff.nii.gz mask.nii.gz 1 {1} 0.002".format(DTITK_ROOT, iter), currentScript)
-    writeRowToFile("echo 'DTI Step 4.{0}: Diffeomorphic Alignment, Iteration {0} -> COMPLETE!'".format(iter), currentScript)
+      writeRowToFile("{0}/scripts/dti_diffeomorphic_reg mean_diffeomorphic_initial.nii.gz ${{scan}}_spd_aff.nii.gz mask.nii.gz 1 {1} {2}".format(DTITK_ROOT, iter, tolerance), currentScript, plan)
+    writeRowToFile("echo 'DTI Step 4.{0}: Diffeomorphic Alignment, Iteration {0} -> COMPLETE!'".format(iter), currentScript, plan)
+
+#Script generation for Step 5: Scalar Maps (Individual Steps), for a batch of scans
+def writeStep5Iter(plan, ScriptsDir, scriptHeader, Maps, suffix, ShouldMonitor, MonitorDir, ShouldKeep):
+    currentScript="{0}/Individual_Maps{1}.sh".format(ScriptsDir, suffix)
+    writeRowToFile(scriptHeader, currentScript, plan)
+    writeRowToFile("echo 'DTI Step 5: Scalar Maps for scans: '$@", currentScript, plan)
+    if ShouldKeep == True:
+      writeRowToFile("cd output", currentScript, plan)
+    writeRowToFile("errcount=0", currentScript, plan)
+    writeRowToFile('for scan in "$@" ; do', currentScript, plan)
+    if ShouldMonitor == True:
+      writeRowToFile("  {0}/statusupdate.py ${{scan}} M{1} Running".format(MonitorDir, suffix), currentScript, plan)
+    writeRowToFile("  scanerrcount=0", currentScript, plan)
+    #MD is derived from TR, so TR is computed whenever either is requested.
+    for scalarMap in ["FA", "TR", "AD", "RD"]:
+      if scalarMap in Maps or (scalarMap == "TR" and "MD" in Maps):
+        writeRowToFile("  if ! TVtool -in ${{scan}}_spd_aff_diffeo.nii.gz -{0} ; then".format(scalarMap.lower()), currentScript, plan)
+        writeRowToFile("    echo 'There was an error with TVtool -{0}'".format(scalarMap.lower()), currentScript, plan)
+        writeRowToFile("    scanerrcount=$((scanerrcount+1))", currentScript, plan)
+        writeRowToFile("  fi", currentScript, plan)
+    if "MD" in Maps:
+      writeRowToFile("  if ! fslmaths ${scan}_spd_aff_diffeo_tr.nii.gz -div 3 ${scan}_spd_aff_diffeo_md.nii.gz ; then", currentScript, plan)
+      writeRowToFile("    echo 'There was an error with fslmaths'", currentScript, plan)
+      writeRowToFile("    scanerrcount=$((scanerrcount+1))", currentScript, plan)
+      writeRowToFile("  fi", currentScript, plan)
+      if "TR" not in Maps:
+        writeRowToFile("  rm -f ${scan}_spd_aff_diffeo_tr.nii.gz", currentScript, plan)
+    if ShouldMonitor == True:
+      writeRowToFile("  if [[ $scanerrcount == 0 ]] ; then", currentScript, plan)
+      writeRowToFile("    {0}/statusupdate.py ${{scan}} M{1} Finished".format(MonitorDir, suffix), currentScript, plan)
+      writeRowToFile("  else", currentScript, plan)
+      writeRowToFile("    {0}/statusupdate.py ${{scan}} M{1} Error".format(MonitorDir, suffix), currentScript, plan)
+      writeRowToFile("  fi", currentScript, plan)
+    writeRowToFile("  errcount=$((errcount+scanerrcount))", currentScript, plan)
+    writeRowToFile("done", currentScript, plan)
+    writeRowToFile("echo 'DTI Step 5: Scalar Maps for scans: '$@' -> COMPLETE!'", currentScript, plan)
+    writeRowToFile("if [[ $errcount != 0 ]] ; then", currentScript, plan)
+    writeRowToFile("  exit 1", currentScript, plan)
+    writeRowToFile("fi", currentScript, plan)
+
+#Script generation for Step 5: Scalar Maps (Group Steps)
+def writeStep5Inter(plan, ScriptsDir, scriptHeader, suffix, ShouldMonitor, MonitorDir, ShouldKeep):
+    currentScript="{0}/Group_Maps{1}.sh".format(ScriptsDir, suffix)
+    writeRowToFile(scriptHeader, currentScript, plan)
+    writeRowToFile("echo 'DTI Step 5.1: Mean FA Mask and Skeleton'", currentScript, plan)
+    if ShouldKeep == True:
+      writeRowToFile("cd output", currentScript, plan)
+    if ShouldMonitor == True:
+      writeRowToFile("{0}/statusupdate.py Group M{1} Running".format(MonitorDir, suffix), currentScript, plan)
+    writeRowToFile("errcount=0", currentScript, plan)
+    #Step 1
+    writeRowToFile("if ! TVtool -in mean.nii.gz -fa ; then", currentScript, plan)
+    writeRowToFile("  echo 'There was an error with TVtool'", currentScript, plan)
+    writeRowToFile("  errcount=$((errcount+1))", currentScript, plan)
+    writeRowToFile("fi", currentScript, plan)
+    #Step 2, with the FA threshold usually used for white matter skeletons
+    writeRowToFile("if ! BinaryThresholdImageFilter mean_fa.nii.gz mean_fa_mask.nii.gz 0.2 100 1 0 ; then", currentScript, plan)
+    writeRowToFile("  echo 'There was an error with BinaryThresholdImageFilter'", currentScript, plan)
+    writeRowToFile("  errcount=$((errcount+1))", currentScript, plan)
+    writeRowToFile("fi", currentScript, plan)
+    #Step 3
+    writeRowToFile("if ! tbss_skeleton -i mean_fa.nii.gz -o mean_fa_skeleton.nii.gz ; then", currentScript, plan)
+    writeRowToFile("  echo 'There was an error with tbss_skeleton'", currentScript, plan)
+    writeRowToFile("  errcount=$((errcount+1))", currentScript, plan)
+    writeRowToFile("fi", currentScript, plan)
+    writeRowToFile("echo 'DTI Step 5.1: Mean FA Mask and Skeleton -> COMPLETE!'", currentScript, plan)
+    if ShouldMonitor == True:
+      writeRowToFile("if [[ $errcount == 0 ]] ; then", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py Group M{1} Finished".format(MonitorDir, suffix), currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py Group M{1} Error".format(MonitorDir, suffix), currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
+    writeRowToFile("if [[ $errcount != 0 ]] ; then", currentScript, plan)
+    writeRowToFile("  exit 1", currentScript, plan)
+    writeRowToFile("fi", currentScript, plan)
 
 #Script generation for Step 2: Rigid Normalization (Group Steps)
-def writeStep2Inter(inter, interMax, ScriptsDir, scriptHeader, regType, ShouldMonitor, MonitorDir):
+def writeStep2Inter(plan, inter, interMax, ScriptsDir, scriptHeader, regType, ShouldMonitor, MonitorDir, ShouldKeep):
     prevInter= inter - 1
     currentScript="{0}/Group_Rigid{1}.sh".format(ScriptsDir, inter)
-    writeRowToFile(scriptHeader, currentScript)
-    writeRowToFile('echo "DTI Step 2.{0}.1: Adjusting Rigid Average for all scans, Iteration {0}"'.format(inter), currentScript)
+    writeRowToFile(scriptHeader, currentScript, plan)
+    writeRowToFile('echo "DTI Step 2.{0}.1: Adjusting Rigid Average for all scans, Iteration {0}"'.format(inter), currentScript, plan)
     if ShouldMonitor == True:
-      writeRowToFile("{0}/statusupdate.py Group R{1} Running".format(MonitorDir, inter), currentScript)
+      writeRowToFile("{0}/statusupdate.py Group R{1} Running".format(MonitorDir, inter), currentScript, plan)
       #Step 1
-      writeRowToFile("errcount=0", currentScript)
-      writeRowToFile("if TVMean -in scan_list_file_aff.txt -out mean_rigid{0}.nii.gz ; then".format(inter), currentScript)
-      writeRowToFile("  errcount=expr $errcount+0", currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  echo 'There was an error with TVMean'", currentScript)
-      writeRowToFile("  errcount=expr $errcount+1", currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("errcount=0", currentScript, plan)
+      writeRowToFile("if TVMean -in scan_list_file_aff.txt -out mean_rigid{0}.nii.gz ; then".format(inter), currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+0", currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  echo 'There was an error with TVMean'", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+1", currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
       #Step 2
-      writeRowToFile("if TVtool -in mean_rigid{0}.nii.gz -sm mean_rigid{1}.nii.gz -SMOption  {2} | grep Similarity | tee -a rigid_normalization.log ; then".format(prevInter, inter, regType), currentScript)
-      writeRowToFile("  errcount=expr $errcount+0", currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  echo 'There was an error with TVtool'", currentScript)
-      writeRowToFile("  errcount=expr $errcount+1", currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("if TVtool -in mean_rigid{0}.nii.gz -sm mean_rigid{1}.nii.gz -SMOption  {2} | grep Similarity | tee -a rigid_normalization.log ; then".format(prevInter, inter, regType), currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+0", currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  echo 'There was an error with TVtool'", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+1", currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
       #Error check and Update
-      writeRowToFile("if [[ $errcount == 0 ]] ; then", currentScript)
-      writeRowToFile("  {0}/statusupdate.py Group R{1} Finished".format(MonitorDir, inter), currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  {0}/statusupdate.py Group R{1} Error".format(MonitorDir, inter), currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("if [[ $errcount == 0 ]] ; then", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py Group R{1} Finished".format(MonitorDir, inter), currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py Group R{1} Error".format(MonitorDir, inter), currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
     else:
-      writeRowToFile("TVMean -in scan_list_file_aff.txt -out mean_rigid{0}.nii.gz".format(inter), currentScript)
-      writeRowToFile("TVtool -in mean_rigid{0}.nii.gz -sm mean_rigid{1}.nii.gz -SMOption  {2} | grep Similarity | tee -a rigid_normalization.log".format(prevInter, inter, regType), currentScript)
-    writeRowToFile('echo "DTI Step 2.{0}.1: Adjusting Rigid Average for all scans, Iteration {0} -> COMPLETE!"'.format(inter), currentScript)
+      writeRowToFile("TVMean -in scan_list_file_aff.txt -out mean_rigid{0}.nii.gz".format(inter), currentScript, plan)
+      writeRowToFile("TVtool -in mean_rigid{0}.nii.gz -sm mean_rigid{1}.nii.gz -SMOption  {2} | grep Similarity | tee -a rigid_normalization.log".format(prevInter, inter, regType), currentScript, plan)
+    writeRowToFile('echo "DTI Step 2.{0}.1: Adjusting Rigid Average for all scans, Iteration {0} -> COMPLETE!"'.format(inter), currentScript, plan)
     if inter == interMax:
-        writeRowToFile("#Prepare for the affine alignment in the next step by copying over the file we just created.", currentScript)
-        writeRowToFile("cp mean_rigid{0}.nii.gz mean_affine0.nii.gz".format(inter), currentScript)
+        writeRowToFile("#Prepare for the affine alignment in the next step by handing over the file we just created.", currentScript, plan)
+        writeRowToFile(linkCommand("mean_rigid{0}.nii.gz".format(inter), "mean_affine0.nii.gz", ShouldKeep), currentScript, plan)
 
 #Script generation for Step 3a: Affine Normalization (Group Steps)
-def writeStep3InterA(inter, interMax, ScriptsDir, scriptHeader, ShouldMonitor, MonitorDir):
+def writeStep3InterA(plan, inter, interMax, ScriptsDir, scriptHeader, ShouldMonitor, MonitorDir):
     prevInter= inter - 1
     currentScript="{0}/Group_Affine{1}A.sh".format(ScriptsDir, inter)
-    writeRowToFile(scriptHeader, currentScript)
-    writeRowToFile('echo "DTI Step 3.{0}a.1: Adjusting Affine Average for all scans, Iteration {0}"'.format(inter), currentScript)
+    writeRowToFile(scriptHeader, currentScript, plan)
+    writeRowToFile('echo "DTI Step 3.{0}a.1: Adjusting Affine Average for all scans, Iteration {0}"'.format(inter), currentScript, plan)
     if ShouldMonitor == True:
-      writeRowToFile("{0}/statusupdate.py Group A{1}A Running".format(MonitorDir, inter), currentScript)
-      writeRowToFile("if affine3DShapeAverage affine.txt mean_affine{0}.nii.gz average_inv.aff 1 ; then".format(prevInter), currentScript)
-      writeRowToFile("  {0}/statusupdate.py Group A{1}A Finished".format(MonitorDir, inter), currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  {0}/statusupdate.py Group A{1}A Error".format(MonitorDir, inter), currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("{0}/statusupdate.py Group A{1}A Running".format(MonitorDir, inter), currentScript, plan)
+      writeRowToFile("if affine3DShapeAverage affine.txt mean_affine{0}.nii.gz average_inv.aff 1 ; then".format(prevInter), currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py Group A{1}A Finished".format(MonitorDir, inter), currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py Group A{1}A Error".format(MonitorDir, inter), currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
     else:
-      writeRowToFile("affine3DShapeAverage affine.txt mean_affine{0}.nii.gz average_inv.aff 1".format(prevInter), currentScript)
-    writeRowToFile('echo "DTI Step 3.{0}a.1: Adjusting Affine Average for all scans, Iteration {0} -> COMPLETE!"'.format(inter), currentScript)
+      writeRowToFile("affine3DShapeAverage affine.txt mean_affine{0}.nii.gz average_inv.aff 1".format(prevInter), currentScript, plan)
+    writeRowToFile('echo "DTI Step 3.{0}a.1: Adjusting Affine Average for all scans, Iteration {0} -> COMPLETE!"'.format(inter), currentScript, plan)
 
 #Script generation for Step 3b: Affine Normalization (Group Steps)
-def writeStep3InterB(inter, interMax, ScriptsDir, scriptHeader, regType, ShouldMonitor, MonitorDir):
+def writeStep3InterB(plan, inter, interMax, ScriptsDir, scriptHeader, regType, ShouldMonitor, MonitorDir, ShouldKeep):
     prevInter= inter - 1
     currentScript="{0}/Group_Affine{1}B.sh".format(ScriptsDir, inter)
-    writeRowToFile(scriptHeader, currentScript)
-    writeRowToFile('echo "DTI Step 3.{0}b.1: Adjusting Affine Average for all scans, Iteration {0}"'.format(inter), currentScript)
+    writeRowToFile(scriptHeader, currentScript, plan)
+    writeRowToFile('echo "DTI Step 3.{0}b.1: Adjusting Affine Average for all scans, Iteration {0}"'.format(inter), currentScript, plan)
     
     if ShouldMonitor == True:
-      writeRowToFile("{0}/statusupdate.py Group A{1}B Running".format(MonitorDir, inter), currentScript)
-      writeRowToFile("errcount=0", currentScript)
-    writeRowToFile("rm -fr average_inv.aff", currentScript) 
+      writeRowToFile("{0}/statusupdate.py Group A{1}B Running".format(MonitorDir, inter), currentScript, plan)
+      writeRowToFile("errcount=0", currentScript, plan)
+    writeRowToFile("rm -fr average_inv.aff", currentScript, plan) 
     if ShouldMonitor == True:
       #Step 1
-      writeRowToFile("if TVMean -in scan_list_file_aff.txt -out mean_affine{0}.nii.gz ; then".format(inter), currentScript)
-      writeRowToFile("  errcount=expr $errcount+0", currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  echo 'There was an error with TVMean'", currentScript)
-      writeRowToFile("  errcount=expr $errcount+1", currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("if TVMean -in scan_list_file_aff.txt -out mean_affine{0}.nii.gz ; then".format(inter), currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+0", currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  echo 'There was an error with TVMean'", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+1", currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
       #Step 2
-      writeRowToFile("if TVtool -in mean_affine{0}.nii.gz -sm mean_affine{1}.nii.gz -SMOption  {2} | grep Similarity | tee -a affine_normalization.log ; then".format(prevInter, inter, regType), currentScript)
-      writeRowToFile("  errcount=expr $errcount+0", currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  echo 'There was an error with TVtool'", currentScript)
-      writeRowToFile("  errcount=expr $errcount+1", currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("if TVtool -in mean_affine{0}.nii.gz -sm mean_affine{1}.nii.gz -SMOption  {2} | grep Similarity | tee -a affine_normalization.log ; then".format(prevInter, inter, regType), currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+0", currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  echo 'There was an error with TVtool'", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+1", currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
     else:
-      writeRowToFile("TVMean -in scan_list_file_aff.txt -out mean_affine{0}.nii.gz".format(inter), currentScript)
-      writeRowToFile("TVtool -in mean_affine{0}.nii.gz -sm mean_affine{1}.nii.gz -SMOption  {2} | grep Similarity | tee -a affine_normalization.log".format(prevInter, inter, regType), currentScript)
+      writeRowToFile("TVMean -in scan_list_file_aff.txt -out mean_affine{0}.nii.gz".format(inter), currentScript, plan)
+      writeRowToFile("TVtool -in mean_affine{0}.nii.gz -sm mean_affine{1}.nii.gz -SMOption  {2} | grep Similarity | tee -a affine_normalization.log".format(prevInter, inter, regType), currentScript, plan)
     
-    writeRowToFile('echo "DTI Step 3.{0}b.1: Adjusting Affine Average for all scans, Iteration {0} -> COMPLETE!"'.format(inter), currentScript)
+    writeRowToFile('echo "DTI Step 3.{0}b.1: Adjusting Affine Average for all scans, Iteration {0} -> COMPLETE!"'.format(inter), currentScript, plan)
     if inter == interMax:
-        writeRowToFile("echo 'Preparing for Diffeomorphic Alignment'", currentScript) 
+        writeRowToFile("echo 'Preparing for Diffeomorphic Alignment'", currentScript, plan) 
         if ShouldMonitor == True:
           #Step 3
-          writeRowToFile("if TVtool -tr -in mean_affine{0}.nii.gz ; then".format(inter), currentScript)
-          writeRowToFile("  errcount=expr $errcount+0", currentScript)
-          writeRowToFile("else", currentScript)
-          writeRowToFile("  echo 'There was an error with TVtool'", currentScript)
-          writeRowToFile("  errcount=expr $errcount+1", currentScript)
-          writeRowToFile("fi", currentScript)
+          writeRowToFile("if TVtool -tr -in mean_affine{0}.nii.gz ; then".format(inter), currentScript, plan)
+          writeRowToFile("  errcount=expr $errcount+0", currentScript, plan)
+          writeRowToFile("else", currentScript, plan)
+          writeRowToFile("  echo 'There was an error with TVtool'", currentScript, plan)
+          writeRowToFile("  errcount=expr $errcount+1", currentScript, plan)
+          writeRowToFile("fi", currentScript, plan)
           #Step 4
-          writeRowToFile("if BinaryThresholdImageFilter mean_affine{0}_tr.nii.gz mask.nii.gz 0 .01 100 1 0 ; then".format(inter), currentScript)
-          writeRowToFile("  errcount=expr $errcount+0", currentScript)
-          writeRowToFile("else", currentScript)
-          writeRowToFile("  echo 'There was an error with BinaryThresholdFilter'", currentScript)
-          writeRowToFile("  errcount=expr $errcount+1", currentScript)
-          writeRowToFile("fi", currentScript)
+          writeRowToFile("if BinaryThresholdImageFilter mean_affine{0}_tr.nii.gz mask.nii.gz 0 .01 100 1 0 ; then".format(inter), currentScript, plan)
+          writeRowToFile("  errcount=expr $errcount+0", currentScript, plan)
+          writeRowToFile("else", currentScript, plan)
+          writeRowToFile("  echo 'There was an error with BinaryThresholdFilter'", currentScript, plan)
+          writeRowToFile("  errcount=expr $errcount+1", currentScript, plan)
+          writeRowToFile("fi", currentScript, plan)
         else:
-          writeRowToFile("TVtool -tr -in mean_affine{0}.nii.gz".format(inter), currentScript)
-          writeRowToFile("BinaryThresholdImageFilter mean_affine{0}_tr.nii.gz mask.nii.gz 0 .01 100 1 0".format(inter), currentScript)
-        writeRowToFile("#Prepare for the diffeomorphic alignment in the next step by copying over the file we just created.", currentScript)
-        writeRowToFile("cp mean_affine{0}.nii.gz mean_diffeomorphic0.nii.gz".format(inter), currentScript)
-        writeRowToFile("ln -sf mean_diffeomorphic0.nii.gz mean_diffeomorphic_initial.nii.gz", currentScript)
+          writeRowToFile("TVtool -tr -in mean_affine{0}.nii.gz".format(inter), currentScript, plan)
+          writeRowToFile("BinaryThresholdImageFilter mean_affine{0}_tr.nii.gz mask.nii.gz 0 .01 100 1 0".format(inter), currentScript, plan)
+        writeRowToFile("#Prepare for the diffeomorphic alignment in the next step by handing over the file we just created.", currentScript, plan)
+        writeRowToFile(linkCommand("mean_affine{0}.nii.gz".format(inter), "mean_diffeomorphic0.nii.gz", ShouldKeep), currentScript, plan)
+        writeRowToFile("ln -sf mean_diffeomorphic0.nii.gz mean_diffeomorphic_initial.nii.gz", currentScript, plan)
     if ShouldMonitor == True:
-      writeRowToFile("if [[ $errcount == 0 ]] ; then", currentScript)
-      writeRowToFile("  {0}/statusupdate.py Group A{1}B Finished".format(MonitorDir, inter), currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  {0}/statusupdate.py Group A{1}B Error".format(MonitorDir, inter), currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("if [[ $errcount == 0 ]] ; then", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py Group A{1}B Finished".format(MonitorDir, inter), currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py Group A{1}B Error".format(MonitorDir, inter), currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
 
 #Script generation for Step 4: Diffeomorphic Normalization (Group Steps)
-def writeStep4Inter(inter, interMax, ScriptsDir, scriptHeader, ShouldMonitor, MonitorDir, ShouldKeep):
+def writeStep4Inter(plan, inter, interMax, ScriptsDir, scriptHeader, suffix, ShouldMonitor, MonitorDir, ShouldKeep):
     prevInter= inter - 1
-    currentScript="{0}/Group_Diffeomorphic{1}.sh".format(ScriptsDir, inter)
-    writeRowToFile(scriptHeader, currentScript)
-    writeRowToFile("echo 'DTI Step 4.{0}.1: Adjusting Diffeomorphic Average for all scans, Iteration {0}'".format(inter), currentScript)
+    currentScript="{0}/Group_Diffeomorphic{1}{2}.sh".format(ScriptsDir, inter, suffix)
+    writeRowToFile(scriptHeader, currentScript, plan)
+    writeRowToFile("echo 'DTI Step 4.{0}.1: Adjusting Diffeomorphic Average for all scans, Iteration {0}'".format(inter), currentScript, plan)
     
     if ShouldMonitor == True:
-      writeRowToFile("{0}/statusupdate.py Group D{1} Running".format(MonitorDir, inter), currentScript)
-      writeRowToFile("errcount=0", currentScript)
+      writeRowToFile("{0}/statusupdate.py Group D{1}{2} Running".format(MonitorDir, inter, suffix), currentScript, plan)
+      writeRowToFile("errcount=0", currentScript, plan)
       #Step 1
-      writeRowToFile("if TVMean -in scan_list_file_aff_diffeo.txt -out mean_diffeomorphic{0}.nii.gz ; then".format(inter), currentScript)
-      writeRowToFile("  errcount=expr $errcount+0", currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  echo 'There was an error with TVMean'", currentScript)
-      writeRowToFile("  errcount=expr $errcount+1", currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("if TVMean -in scan_list_file_aff_diffeo.txt -out mean_diffeomorphic{0}.nii.gz ; then".format(inter), currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+0", currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  echo 'There was an error with TVMean'", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+1", currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
       #Step 2
-      writeRowToFile("if VVMean -in diffeo.txt -out mean_df.nii.gz ; then", currentScript)
-      writeRowToFile("  errcount=expr $errcount+0", currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  echo 'There was an error with VVMean'", currentScript)
-      writeRowToFile("  errcount=expr $errcount+1", currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("if VVMean -in diffeo.txt -out mean_df.nii.gz ; then", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+0", currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  echo 'There was an error with VVMean'", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+1", currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
       #Step 3
-      writeRowToFile("if dfToInverse -in mean_df.nii.gz ; then", currentScript)
-      writeRowToFile("  errcount=expr $errcount+0", currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  echo 'There was an error with dfToInverse'", currentScript)
-      writeRowToFile("  errcount=expr $errcount+1", currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("if dfToInverse -in mean_df.nii.gz ; then", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+0", currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  echo 'There was an error with dfToInverse'", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+1", currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
       #Step 4
-      writeRowToFile("if deformationSymTensor3DVolume -in mean_diffeomorphic{0}.nii.gz -out mean_diffeomorphic{0}.nii.gz -trans mean_df_inv.nii.gz ; then".format(inter), currentScript)
-      writeRowToFile("  errcount=expr $errcount+0", currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  echo 'There was an error with deformationSymTensor3DVolume'", currentScript)
-      writeRowToFile("  errcount=expr $errcount+1", currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("if deformationSymTensor3DVolume -in mean_diffeomorphic{0}.nii.gz -out mean_diffeomorphic{0}.nii.gz -trans mean_df_inv.nii.gz ; then".format(inter), currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+0", currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  echo 'There was an error with deformationSymTensor3DVolume'", currentScript, plan)
+      writeRowToFile("  errcount=expr $errcount+1", currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
     else:
-      writeRowToFile("TVMean -in scan_list_file_aff_diffeo.txt -out mean_diffeomorphic{0}.nii.gz".format(inter), currentScript)
-      writeRowToFile("VVMean -in diffeo.txt -out mean_df.nii.gz", currentScript)
-      writeRowToFile("dfToInverse -in mean_df.nii.gz", currentScript)
-      writeRowToFile("deformationSymTensor3DVolume -in mean_diffeomorphic{0}.nii.gz -out mean_diffeomorphic{0}.nii.gz -trans mean_df_inv.nii.gz".format(inter), currentScript)
-    writeRowToFile("#Clear up the temporary files", currentScript)
-    writeRowToFile("rm -fr mean_diffeomorphic_initial.nii.gz", currentScript)
+      writeRowToFile("TVMean -in scan_list_file_aff_diffeo.txt -out mean_diffeomorphic{0}.nii.gz".format(inter), currentScript, plan)
+      writeRowToFile("VVMean -in diffeo.txt -out mean_df.nii.gz", currentScript, plan)
+      writeRowToFile("dfToInverse -in mean_df.nii.gz", currentScript, plan)
+      writeRowToFile("deformationSymTensor3DVolume -in mean_diffeomorphic{0}.nii.gz -out mean_diffeomorphic{0}.nii.gz -trans mean_df_inv.nii.gz".format(inter), currentScript, plan)
+    writeRowToFile("#Clear up the temporary files", currentScript, plan)
+    writeRowToFile("rm -fr mean_diffeomorphic_initial.nii.gz", currentScript, plan)
     if inter != interMax:
-        writeRowToFile("#Make the new working file.", currentScript)
-        writeRowToFile("ln -sf mean_diffeomorphic{0}.nii.gz mean_diffeomorphic_initial.nii.gz".format(inter), currentScript)
-    writeRowToFile("echo 'DTI Step 4.{0}.1: Adjusting Diffeomorphic Average for all scans, Iteration {0} -> COMPLETE!'".format(inter), currentScript)
+        writeRowToFile("#Make the new working file.", currentScript, plan)
+        writeRowToFile("ln -sf mean_diffeomorphic{0}.nii.gz mean_diffeomorphic_initial.nii.gz".format(inter), currentScript, plan)
+    writeRowToFile("echo 'DTI Step 4.{0}.1: Adjusting Diffeomorphic Average for all scans, Iteration {0} -> COMPLETE!'".format(inter), currentScript, plan)
     if inter == interMax:
-        writeRowToFile("mkdir output", currentScript)
-        writeRowToFile("cp mean_diffeomorphic{0}.nii.gz output/mean.nii.gz".format(inter), currentScript)
-        writeRowToFile("cp *_diffeo.nii.gz output/", currentScript)
-        writeRowToFile("cp *.df.nii.gz output/", currentScript)
-        writeRowToFile("cp *.aff output/", currentScript)
+        #Only file names change hands here; without --keep the results are renamed, otherwise they are linked.
+        writeRowToFile("mkdir output", currentScript, plan)
+        writeRowToFile(linkCommand("mean_diffeomorphic{0}.nii.gz".format(inter), "output/mean.nii.gz", ShouldKeep), currentScript, plan)
+        writeRowToFile("for file in *_diffeo.nii.gz *.df.nii.gz ; do", currentScript, plan)
+        writeRowToFile("  {0}".format(linkCommand("${file}", "output/${file}", ShouldKeep)), currentScript, plan)
+        writeRowToFile("done", currentScript, plan)
+        #The affine files of a sweep branch are symlinks into the shared prefix, so they are always linked.
+        writeRowToFile("for file in *.aff ; do", currentScript, plan)
+        writeRowToFile("  {0}".format(linkCommand("${file}", "output/${file}", True)), currentScript, plan)
+        writeRowToFile("done", currentScript, plan)
         if ShouldKeep == False:
            #Remove all files that aren't in "output"
-           writeRowToFile("rm -f *.*", currentScript)
-           writeRowToFile("mv output/* ./", currentScript)
-           writeRowToFile("rm -rf output", currentScript)
-        writeRowToFile("echo '#'", currentScript)
-        writeRowToFile("echo 'ALL DONE'", currentScript)
+           writeRowToFile("rm -f *.*", currentScript, plan)
+           writeRowToFile("mv output/* ./", currentScript, plan)
+           writeRowToFile("rm -rf output", currentScript, plan)
+        writeRowToFile("echo '#'", currentScript, plan)
+        writeRowToFile("echo 'ALL DONE'", currentScript, plan)
     if ShouldMonitor == True:
-      writeRowToFile("if [[ $errcount == 0 ]] ; then", currentScript)
-      writeRowToFile("  {0}/statusupdate.py Group D{1} Finished".format(MonitorDir, inter), currentScript)
-      writeRowToFile("else", currentScript)
-      writeRowToFile("  {0}/statusupdate.py Group D{1} Error".format(MonitorDir, inter), currentScript)
-      writeRowToFile("fi", currentScript)
+      writeRowToFile("if [[ $errcount == 0 ]] ; then", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py Group D{1}{2} Finished".format(MonitorDir, inter, suffix), currentScript, plan)
+      writeRowToFile("else", currentScript, plan)
+      writeRowToFile("  {0}/statusupdate.py Group D{1}{2} Error".format(MonitorDir, inter, suffix), currentScript, plan)
+      writeRowToFile("fi", currentScript, plan)
 
 #============================================================================
 #============ Main ==========================================================
 
-def setup(arguments):   
-    print
-    #Directory Creation and Cleanup
-    print("## Directory Creation and Cleanup ##")
-    createDir(arguments["NormDir"])
-    createDir(arguments["ScriptsDir"])
-    cleanUpNormFromPrev(arguments["NormDir"])
-    cleanUpScriptsFromPrev(arguments["ScriptsDir"])
-    createSubDir(arguments["ScriptsDir"], "condorlogs")
-    createSubDir(arguments["ScriptsDir"], "condorsubmit")
-    print
+def createPlan(arguments):
+    #Build the whole pipeline in memory. Only the subject file, the sweep file, the scans' geometry and the cache statistics are read.
+    #Each call returns a new plan, so several can be built and kept in one process.
+    plan = {"arguments":arguments, "phases":[], "dirs":[], "links":[], "files":OrderedDict(), "bytes":0, "monitor":None}
+    #Registration Cache
+    if arguments["CacheDir"] != False:
+      beginPhase(plan["phases"], "Registration Cache", planTotals(plan))
+      plan["dirs"].append(arguments["CacheDir"])
+      reportCache(arguments["CacheDir"])
     
     #CSV File Parsing
-    print("## CSV File Parsing ##")
+    beginPhase(plan["phases"], "CSV File Parsing", planTotals(plan))
     scans = parseCSV(arguments["SubjectFile"])
-    print
+    plan["scans"] = scans
     
     #Defining Additional Dimension Variables
-    print("## Defining Additional Dimension Variables ##")
+    beginPhase(plan["phases"], "Defining Additional Dimension Variables", planTotals(plan))
     arguments = addDimVars(scans, arguments)
-    print(arguments)
+    reportGrid(arguments, len(scans))
     
     #Scan List Creation
-    print("## Scan List Creation ##")
-    createScanLists(scans, arguments["NormDir"])
-    print
+    beginPhase(plan["phases"], "Scan List Creation", planTotals(plan))
+    createScanLists(plan, scans, arguments["NormDir"])
     
     #Scan Link Creation
-    print("## Scan Link Creation ##")
-    linkScans(scans, arguments["NormDir"])
-    print
+    beginPhase(plan["phases"], "Scan Link Creation", planTotals(plan))
+    plan["links"].extend(scanLinks(scans, arguments["NormDir"]))
+    
+    #Diffeomorphic Variant Creation
+    beginPhase(plan["phases"], "Diffeomorphic Variant Creation", planTotals(plan))
+    variants = createDiffeoVariants(arguments)
+    for variant in variants:
+      if variant["NormDir"] != arguments["NormDir"]:
+        plan["dirs"].append(variant["NormDir"])
+        createScanLists(plan, scans, variant["NormDir"])
+        plan["links"].extend(variantLinks(scans, variant["NormDir"]))
+    plan["variants"] = variants
     
     #Script List Creation
-    print("## Script List Creation ##")
-    individualScriptList = createIndividualScriptsList(arguments["RigidIterationMax"], arguments["AffineIterationMax"], arguments["DiffeomorphicIterationMax"])
-    groupScriptList = createGroupScriptsList(arguments["RigidIterationMax"], arguments["AffineIterationMax"], arguments["DiffeomorphicIterationMax"])
-    print
+    beginPhase(plan["phases"], "Script List Creation", planTotals(plan))
+    individualScriptList = createIndividualScriptsList(arguments["RigidIterationMax"], arguments["AffineIterationMax"])
+    groupScriptList = createGroupScriptsList(arguments["RigidIterationMax"], arguments["AffineIterationMax"])
+    for variant in variants:
+      variant["groupScriptList"], variant["individualScriptList"], variant["chain"] = createDiffeomorphicScriptsLists(variant["ITERATIONS"], variant["SUFFIX"])
+      if len(arguments["Maps"]) > 0:
+        mapGroupScriptList, mapIndividualScriptList, mapChain = createMapScriptsLists(variant["SUFFIX"])
+        variant["groupScriptList"] = variant["groupScriptList"] + mapGroupScriptList
+        variant["chain"] = variant["chain"] + mapChain
+        variant["mapScriptList"] = mapIndividualScriptList
+      else:
+        variant["mapScriptList"] = []
+    mapBatches = createMapBatches(scans, arguments["MapBatchSize"])
+    batches = {}
+    for variant in variants:
+      for script in variant["mapScriptList"]:
+        batches[script] = mapBatches
     
     #Condor Submit File Creation
-    print("## Condor Submit File Creation ##")
-    createSubmitIndiv(arguments["ScriptsDir"], arguments["NormDir"], individualScriptList, scans)
-    createSubmitGrp(arguments["ScriptsDir"], arguments["NormDir"], groupScriptList)
-    print
+    beginPhase(plan["phases"], "Condor Submit File Creation", planTotals(plan))
+    createSubmitIndiv(plan, arguments["ScriptsDir"], arguments["NormDir"], individualScriptList, scans)
+    createSubmitGrp(plan, arguments["ScriptsDir"], arguments["NormDir"], groupScriptList, arguments["ConcurrencyLimit"])
+    for variant in variants:
+      createSubmitIndiv(plan, arguments["ScriptsDir"], variant["NormDir"], variant["individualScriptList"], scans)
+      createSubmitIndiv(plan, arguments["ScriptsDir"], variant["NormDir"], variant["mapScriptList"], mapBatches)
+      createSubmitGrp(plan, arguments["ScriptsDir"], variant["NormDir"], variant["groupScriptList"], arguments["ConcurrencyLimit"])
     
     #DAG File Creation
-    print("## DAG File Creation ##")
-    createDAG(arguments["ScriptsDir"], groupScriptList, individualScriptList, scans)
-    print
+    beginPhase(plan["phases"], "DAG File Creation", planTotals(plan))
+    chains = [createChain(groupScriptList, individualScriptList)]
+    for variant in variants:
+      chains.append([groupScriptList[-1]] + variant["chain"])
+    plan["chains"] = chains
+    plan["nodes"] = createDAGNodes(arguments["ScriptsDir"], chains, scans, batches)
+    plan["edges"] = createDAGEdges(chains, scans, batches)
+    plan["stages"] = createStages(plan["nodes"])
+    createDAG(plan, arguments["ScriptsDir"], plan["nodes"], plan["edges"], arguments["MaxJobs"])
+    createStagesFile(plan, arguments["ScriptsDir"], scans, plan["stages"], chains)
     
     #Job Monitoring
     if arguments["ShouldMonitor"] == True:
-      import SetupJobMonitor
+      beginPhase(plan["phases"], "Job Monitoring", planTotals(plan))
       #Make Jobs Object
       jobsObj = createJobObjForMonitor(scans)
       #Make Events Object
-      eventsObj = createEventObjForMonitor(arguments["RigidIterationMax"], arguments["AffineIterationMax"], arguments["DiffeomorphicIterationMax"])
+      eventsObj = createEventObjForMonitor(arguments["RigidIterationMax"], arguments["AffineIterationMax"], variants, len(arguments["Maps"]) > 0)
       #Assemble JobMonitor Arguments
-      argsForMonitor = {"processName":"DTITK | Live Updates", "monitorDir":arguments["MonitorDir"], "jobs":jobsObj, "events":eventsObj}
-      
-      #Run SetupJobMonitor.py
-      SetupJobMonitor.create(argsForMonitor)
-      
+      plan["monitor"] = {"processName":"DTITK | Live Updates", "monitorDir":arguments["MonitorDir"], "jobs":jobsObj, "events":eventsObj}
+      log.info("Monitor page planned with {0} jobs and {1} events.".format(len(jobsObj), len(eventsObj)))
+      log.info("For a live ETA next to it, run: ForecastCondorDTITK.py {0} {1}".format(arguments["ScriptsDir"], arguments["MonitorDir"]))
+    
     #Script Creation
-    print("## Script Creation ##")
-    print "Script generation for Step 1:  Bootstrapping"
-    writeStep1(arguments["ScriptsDir"], arguments["scriptHeader"], arguments["xsize"], arguments["ysize"], arguments["zsize"], arguments["ShouldMonitor"], arguments["MonitorDir"])
+    beginPhase(plan["phases"], "Script Creation", planTotals(plan))
+    writeScripts(plan, arguments, variants)
+    endPhase(plan["phases"], planTotals(plan))
+    
+    #Join the rows collected for each file into its contents
+    for filename, rows in plan["files"].items():
+      plan["files"][filename] = "".join(rows)
+    del plan["bytes"]
+    return plan
+
+def writeScripts(plan, arguments, variants):
+    log.info("Script generation for shared helpers")
+    writeHelpers(plan, arguments["ScriptsDir"], arguments["DTITK_ROOT"], arguments["CacheDir"], arguments["CacheSizeMB"])
     
-    print "Script generation for Step 2:  Rigid Normalization (Individual Steps)"
+    log.info("Script generation for Step 1:  Bootstrapping")
+    writeStep1(plan, arguments["ScriptsDir"], arguments["scriptHeader"], arguments["xsize"], arguments["ysize"], arguments["zsize"], arguments["xgrid"], arguments["ygrid"], arguments["zgrid"], arguments["ShouldMonitor"], arguments["MonitorDir"], arguments["ShouldKeep"])
+    
+    log.info("Script generation for Step 2:  Rigid Normalization (Individual Steps)")
     for iter in range(1, arguments["RigidIterationMax"] + 1):
-      writeStep2Iter(iter, arguments["RigidIterationMax"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["DTITK_ROOT"], arguments["regType"], arguments["sep_coarse"], arguments["ShouldMonitor"], arguments["MonitorDir"])
+      writeStep2Iter(plan, iter, arguments["RigidIterationMax"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["DTITK_ROOT"], arguments["regType"], arguments["sep_coarse"], arguments["ShouldMonitor"], arguments["MonitorDir"], arguments["CacheDir"])
     
-    print "Script generation for Step 2:  Rigid Normalization (Group Steps)"
+    log.info("Script generation for Step 2:  Rigid Normalization (Group Steps)")
     for inter in range(1, arguments["RigidIterationMax"] + 1):
-      writeStep2Inter(inter, arguments["RigidIterationMax"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["regType"], arguments["ShouldMonitor"], arguments["MonitorDir"])
+      writeStep2Inter(plan, inter, arguments["RigidIterationMax"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["regType"], arguments["ShouldMonitor"], arguments["MonitorDir"], arguments["ShouldKeep"])
     
-    print "Script generation for Step 3a: Affine Normalization (Individual Steps)"
+    log.info("Script generation for Step 3a: Affine Normalization (Individual Steps)")
     for iter in range(1, arguments["AffineIterationMax"] + 1):
-      writeStep3IterA(iter, arguments["AffineIterationMax"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["DTITK_ROOT"], arguments["regType"], arguments["sep_coarse"], arguments["ShouldMonitor"], arguments["MonitorDir"])
+      writeStep3IterA(plan, iter, arguments["AffineIterationMax"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["DTITK_ROOT"], arguments["regType"], arguments["sep_coarse"], arguments["ShouldMonitor"], arguments["MonitorDir"], arguments["CacheDir"])
     
-    print "Script generation for Step 3a: Affine Normalization (Group Steps)"
+    log.info("Script generation for Step 3a: Affine Normalization (Group Steps)")
     for inter in range(1, arguments["AffineIterationMax"] + 1):
-      writeStep3InterA(inter, arguments["AffineIterationMax"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["ShouldMonitor"], arguments["MonitorDir"])
+      writeStep3InterA(plan, inter, arguments["AffineIterationMax"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["ShouldMonitor"], arguments["MonitorDir"])
     
-    print "Script generation for Step 3b: Affine Normalization (Individual Steps)"
+    log.info("Script generation for Step 3b: Affine Normalization (Individual Steps)")
     for iter in range(1, arguments["AffineIterationMax"] + 1):
-      writeStep3IterB(iter, arguments["AffineIterationMax"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["ShouldMonitor"], arguments["MonitorDir"])
+      writeStep3IterB(plan, iter, arguments["AffineIterationMax"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["ShouldMonitor"], arguments["MonitorDir"])
     
-    print "Script generation for Step 3b: Affine Normalization (Group Steps)"
+    log.info("Script generation for Step 3b: Affine Normalization (Group Steps)")
     for inter in range(1, arguments["AffineIterationMax"] + 1):
-      writeStep3InterB(inter, arguments["AffineIterationMax"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["regType"], arguments["ShouldMonitor"], arguments["MonitorDir"])
+      writeStep3InterB(plan, inter, arguments["AffineIterationMax"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["regType"], arguments["ShouldMonitor"], arguments["MonitorDir"], arguments["ShouldKeep"])
     
-    print "Script generation for Step 4:  Diffeomorphic Normalization (Individual Steps)"
-    for iter in range(1, arguments["DiffeomorphicIterationMax"] + 1):
-      writeStep4Iter(iter, arguments["DiffeomorphicIterationMax"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["DTITK_ROOT"], arguments["ShouldMonitor"], arguments["MonitorDir"])
+    for variant in variants:
+      log.info("Script generation for Step 4:  Diffeomorphic Normalization (Individual Steps){0}".format(variant["SUFFIX"]))
+      for iter in range(1, variant["ITERATIONS"] + 1):
+        writeStep4Iter(plan, iter, variant["ITERATIONS"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["DTITK_ROOT"], variant["TOLERANCE"], variant["SUFFIX"], arguments["ShouldMonitor"], arguments["MonitorDir"])
+      
+      log.info("Script generation for Step 4:  Diffeomorphic Normalization (Group Steps){0}".format(variant["SUFFIX"]))
+      for inter in range(1, variant["ITERATIONS"] + 1):
+        writeStep4Inter(plan, inter, variant["ITERATIONS"], arguments["ScriptsDir"], arguments["scriptHeader"], variant["SUFFIX"], arguments["ShouldMonitor"], arguments["MonitorDir"], arguments["ShouldKeep"])
+      
+      if len(arguments["Maps"]) > 0:
+        log.info("Script generation for Step 5:  Scalar Maps{0}".format(variant["SUFFIX"]))
+        writeStep5Iter(plan, arguments["ScriptsDir"], arguments["scriptHeader"], arguments["Maps"], variant["SUFFIX"], arguments["ShouldMonitor"], arguments["MonitorDir"], arguments["ShouldKeep"])
+        writeStep5Inter(plan, arguments["ScriptsDir"], arguments["scriptHeader"], variant["SUFFIX"], arguments["ShouldMonitor"], arguments["MonitorDir"], arguments["ShouldKeep"])
+
+def materialize(plan):
+    #Write a plan out: clean up after previous runs, then create the directories, links, files and monitor page.
+    arguments = plan["arguments"]
+    totals = {"FILES":0, "BYTES":0, "LINKS":0}
     
-    print "Script generation for Step 4:  Diffeomorphic Normalization (Group Steps)"
-    for inter in range(1, arguments["DiffeomorphicIterationMax"] + 1):
-      writeStep4Inter(inter, arguments["DiffeomorphicIterationMax"], arguments["ScriptsDir"], arguments["scriptHeader"], arguments["ShouldMonitor"], arguments["MonitorDir"], arguments["ShouldKeep"])
+    #Directory Creation and Cleanup
+    beginPhase(plan["phases"], "Directory Creation and Cleanup", totals)
+    createDir(arguments["NormDir"])
+    createDir(arguments["ScriptsDir"])
+    cleanUpNormFromPrev(arguments["NormDir"])
+    cleanUpScriptsFromPrev(arguments["ScriptsDir"])
+    createSubDir(arguments["ScriptsDir"], "condorlogs")
+    createSubDir(arguments["ScriptsDir"], "condorsubmit")
+    for Dir in plan["dirs"]:
+      createDir(Dir)
+    
+    #Link Creation
+    beginPhase(plan["phases"], "Link Creation", totals)
+    for source, link in plan["links"]:
+      os.symlink(source, link)
+      totals["LINKS"] = totals["LINKS"] + 1
+    log.info("{0} links created.".format(totals["LINKS"]))
     
-    #Make those scripts executable.
-    for script in glob.glob("{0}/*.sh".format(arguments["ScriptsDir"])):
-      os.chmod(script, os.stat(script).st_mode | 0111) 
-    print
-    print("Setup Complete")
+    #File Writing
+    beginPhase(plan["phases"], "File Writing", totals)
+    for filename, contents in plan["files"].items():
+      log.debug("Writing '{0}'".format(filename))
+      writeFile(filename, contents)
+      #Make those scripts executable.
+      if filename.endswith(".sh"):
+        os.chmod(filename, os.stat(filename).st_mode | 0111)
+      totals["FILES"] = totals["FILES"] + 1
+      totals["BYTES"] = totals["BYTES"] + len(contents)
+    log.info("{0} files written.".format(totals["FILES"]))
+    
+    #Job Monitoring
+    if plan["monitor"] != None:
+      beginPhase(plan["phases"], "Job Monitoring", totals)
+      import SetupJobMonitor
+      #Run SetupJobMonitor.py
+      SetupJobMonitor.create(plan["monitor"])
+    endPhase(plan["phases"], totals)
+    return plan
+
+def setup(arguments):
+    plan = materialize(createPlan(arguments))
+    summarizePhases(plan["phases"])
+    log.info("Setup Complete")
+    return plan
+
+#============================================================================
+#============ Phase Reporting ===============================================
+
+def planTotals(plan):
+    return {"FILES":len(plan["files"]), "BYTES":plan["bytes"], "LINKS":len(plan["links"])}
+
+def beginPhase(phases, name, totals):
+    #Start timing a phase, closing the one before it. totals are the running FILES, BYTES and LINKS counts.
+    endPhase(phases, totals)
+    log.info("## {0} ##".format(name))
+    phases.append({"NAME":name, "START":time.time(), "TOTALS":dict(totals)})
+
+def endPhase(phases, totals):
+    #Record how long the last phase took and how many files, bytes and links it added.
+    if len(phases) > 0 and "TOTALS" in phases[-1]:
+      phase = phases[-1]
+      phase["SECONDS"] = time.time() - phase.pop("START")
+      startTotals = phase.pop("TOTALS")
+      for key in ["FILES", "BYTES", "LINKS"]:
+        phase[key] = totals[key] - startTotals[key]
+      log.info("")
+
+def summarizePhases(phases):
+    log.info("## Summary ##")
+    for phase in phases:
+      log.info("{0:<40} {1:8.3f}s {2:7d} files {3:10d} bytes {4:7d} links".format(phase["NAME"], phase["SECONDS"], phase["FILES"], phase["BYTES"], phase["LINKS"]))
+    log.info("{0:<40} {1:8.3f}s".format("Total", sum([phase["SECONDS"] for phase in phases])))
+    log.info("")
 
 #============================================================================
 #============ DocOpt ========================================================
 
+class CommandLineFormatter(logging.Formatter):
+    #Progress is printed as is, warnings and errors with their level in front.
+    def format(self, record):
+      if record.levelno >= logging.WARNING:
+        return "{0}: {1}".format(record.levelname, record.getMessage())
+      return record.getMessage()
+
 def go(args):
     #Argument Parsing
     arguments = docopt(doc, argv=args, version='DTITK Condor Setup {0}'.format(Version))
-    print("## Argument Parsing ##")
-    arguments = cleanArguments(arguments)
-    printInputs(arguments)
-    print
-    setup(arguments)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(CommandLineFormatter())
+    log.addHandler(handler)
+    if arguments["--verbose"]:
+      log.setLevel(logging.DEBUG)
+    elif arguments["--quiet"]:
+      log.setLevel(logging.WARNING)
+    else:
+      log.setLevel(logging.INFO)
+    log.info("## Argument Parsing ##")
+    try:
+      arguments = cleanArguments(arguments)
+      printInputs(arguments)
+      log.info("")
+      setup(arguments)
+    except SetupError as error:
+      log.error(str(error))
+      sys.exit(1)
 
 #============================================================================
 #============ Main ==========================================================
@@ -892,5 +1611,3 @@ if __name__ == '__main__':
     args = sys.argv
     del args[0]    
     go(args)
-else:
-    print("Encountered an error in your input")
\ No newline at end of file